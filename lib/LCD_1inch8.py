@@ -29,14 +29,40 @@ class LCD_1inch8(lcdconfig.RaspberryPi):
     LCD_Y_Adjust    = LCD_Y
     width           = LCD_WIDTH
     height          = LCD_HEIGHT 
+    MEMORY          = (132, 162)
+    MADCTL          = 0x60
+    OFFSET          = (LCD_Y, LCD_X)
+    INIT = (
+        (0xB1, (0x01, 0x2C, 0x2D), 0),
+        (0xB2, (0x01, 0x2C, 0x2D), 0),
+        (0xB3, (0x01, 0x2C, 0x2D, 0x01, 0x2C, 0x2D), 0),
+        # Column inversion
+        (0xB4, (0x07,), 0),
+        # ST7735R Power Sequence
+        (0xC0, (0xA2, 0x02, 0x84), 0),
+        (0xC1, (0xC5,), 0),
+        (0xC2, (0x0A, 0x00), 0),
+        (0xC3, (0x8A, 0x2A), 0),
+        (0xC4, (0x8A, 0xEE), 0),
+        (0xC5, (0x0E,), 0),               # VCOM
+        # ST7735R Gamma Sequence
+        (0xE0, (0x0F, 0x1A, 0x0F, 0x18, 0x2F, 0x28, 0x20, 0x22, 0x1F, 0x1B, 0x23, 0x37, 0x00, 0x07, 0x02, 0x10), 0),
+        (0xE1, (0x0F, 0x1B, 0x0F, 0x17, 0x33, 0x2C, 0x29, 0x2E, 0x30, 0x30, 0x39, 0x3F, 0x00, 0x07, 0x03, 0x10), 0),
+        # Enable test command
+        (0xF0, (0x01,), 0),
+        # Disable ram power save mode
+        (0xF6, (0x00,), 0),
+        (0x3A, None, 0),                  # set_pixel_format()
+    )
+
     def command(self, cmd):
         self.digital_write(self.DC_PIN, False)
         self.spi_writebyte([cmd])
-        
+
     def data(self, val):
         self.digital_write(self.DC_PIN, True)
         self.spi_writebyte([val])
-        
+
     def reset(self):
         """Reset the display"""
         self.digital_write(self.RST_PIN,True)
@@ -77,110 +103,23 @@ class LCD_1inch8(lcdconfig.RaspberryPi):
             else:        #R2L_D2U
                 MemoryAccessReg_Data = 0x40 | 0x80 | 0x20
         
-        # Set the read / write scan direction of the frame memory
-        self.command(0x36)        #MX, MY, RGB mode 
-        self.data( MemoryAccessReg_Data & 0xf7)    #RGB color filter panel    
-    def Init_reg(self):
-        """Initialize dispaly"""  
-        self.command(0xB1)
-        self.data(0x01)
-        self.data(0x2C)
-        self.data(0x2D)
-
-        self.command(0xB2)
-        self.data(0x01)
-        self.data(0x2C)
-        self.data(0x2D)
-
-        self.command(0xB3)
-        self.data(0x01)
-        self.data(0x2C)
-        self.data(0x2D)
-        self.data(0x01)
-        self.data(0x2C)
-        self.data(0x2D)
-        
-        #Column inversion 
-        self.command(0xB4)
-        self.data(0x07)
-        
-        #ST7735R Power Sequence
-        self.command(0xC0)
-        self.data(0xA2)
-        self.data(0x02)
-        self.data(0x84)
-        self.command(0xC1)
-        self.data(0xC5)
-
-        self.command(0xC2)
-        self.data(0x0A)
-        self.data(0x00)
+        # The scan direction is rotation 0; set_rotation() turns the picture from there
+        self.width, self.height = self.LCD_Dis_Column, self.LCD_Dis_Page
+        self.MADCTL = MemoryAccessReg_Data & 0xf7    #RGB color filter panel
+        self.OFFSET = (self.LCD_X_Adjust, self.LCD_Y_Adjust)
 
-        self.command(0xC3)
-        self.data(0x8A)
-        self.data(0x2A)
-        self.command(0xC4)
-        self.data(0x8A)
-        self.data(0xEE)
-        
-        self.command(0xC5)#VCOM 
-        self.data(0x0E)
-        
-        #ST7735R Gamma Sequence
-        self.command(0xe0)
-        self.data(0x0f)
-        self.data(0x1a)
-        self.data(0x0f)
-        self.data(0x18)
-        self.data(0x2f)
-        self.data(0x28)
-        self.data(0x20)
-        self.data(0x22)
-        self.data(0x1f)
-        self.data(0x1b)
-        self.data(0x23)
-        self.data(0x37)
-        self.data(0x00)
-        self.data(0x07)
-        self.data(0x02)
-        self.data(0x10)
+        # Set the read / write scan direction of the frame memory
+        self.set_rotation(self.rotation)
+    def Init_reg(self, pixel_format = 'rgb565'):
+        """Initialize dispaly"""
+        self.send_init(self.INIT, pixel_format)
 
-        self.command(0xe1)
-        self.data(0x0f)
-        self.data(0x1b)
-        self.data(0x0f)
-        self.data(0x17)
-        self.data(0x33)
-        self.data(0x2c)
-        self.data(0x29)
-        self.data(0x2e)
-        self.data(0x30)
-        self.data(0x30)
-        self.data(0x39)
-        self.data(0x3f)
-        self.data(0x00)
-        self.data(0x07)
-        self.data(0x03)
-        self.data(0x10) 
-        
-        #Enable test command
-        self.command(0xF0)
-        self.data(0x01)
-        
-        #Disable ram power save mode
-        self.command(0xF6)
-        self.data(0x00)
-        
-        #65k mode
-        self.command(0x3A)
-        self.data(0x05)
-        
-    def Init(self,Lcd_ScanDir=U2D_R2L):
+    def Init(self,Lcd_ScanDir=U2D_R2L,pixel_format='rgb565'):
         self.module_init()
         self.reset()
 
         #Set the initialization register
-        self.Init_reg()
+        self.Init_reg(pixel_format)
 
         #Set the display scan and color transfer modes    
         self.SetGramScanWay( Lcd_ScanDir )
@@ -194,68 +133,8 @@ class LCD_1inch8(lcdconfig.RaspberryPi):
         self.command(0x29)
 
         self.clear()   
-  
-    def SetWindows(self, Xstart, Ystart, Xend, Yend):
-        #set the X coordinates
-        self.command ( 0x2A )
-        self.data ( 0x00 )                                            #Set the horizontal starting point to the high octet
-        self.data ( (Xstart & 0xff) + self.LCD_X_Adjust)            #Set the horizontal starting point to the low octet
-        self.data ( 0x00 )                                            #Set the horizontal end to the high octet
-        self.data ( (( Xend - 1 ) & 0xff) + self.LCD_X_Adjust)        #Set the horizontal end to the low octet
-
-        #set the Y coordinates
-        self.command ( 0x2B )
-        self.data ( 0x00 )
-        self.data ( (Ystart & 0xff) + self.LCD_Y_Adjust)
-        self.data ( 0x00 )
-        self.data ( ( (Yend - 1) & 0xff )+ self.LCD_Y_Adjust)
 
-        self.command(0x2C)  
-        
     def clear(self, color=0XFFFF):
-        _buffer = [color]*(self.LCD_Dis_Column * self.LCD_Dis_Page * 2)
-        if (self.LCD_Scan_Dir == L2R_U2D) or (self.LCD_Scan_Dir == L2R_D2U) or (self.LCD_Scan_Dir == R2L_U2D) or (self.LCD_Scan_Dir == R2L_D2U) :
-            # self.LCD_SetArealColor(0,0, LCD_X_MAXPIXEL , LCD_Y_MAXPIXEL  , Color = color)#white
-            self.SetWindows( 0 , 0 , LCD_X_MAXPIXEL , LCD_Y_MAXPIXEL  )
-            self.digital_write(self.DC_PIN,True)
-            for i in range(0,len(_buffer),4096):
-                self.spi_writebyte(_buffer[i:i+4096])        
-            
-        else:
-            # self.LCD_SetArealColor(0,0, LCD_Y_MAXPIXEL , LCD_X_MAXPIXEL  , Color = color)#white
-            self.SetWindows( 0 , 0 , LCD_Y_MAXPIXEL , LCD_X_MAXPIXEL  )
-            self.digital_write(self.DC_PIN,True)
-            for i in range(0,len(_buffer),4096):
-                self.spi_writebyte(_buffer[i:i+4096])    
-            
-    
-    def ShowImage(self,Image):
-        if (Image == None):
-            return
-        
-        imwidth, imheight = Image.size
-        if imwidth != self.width or imheight != self.height:
-            raise ValueError('Image must be same dimensions as display \
-                ({0}x{1}).' .format(self.width, self.height))
-        img = self.np.asarray(Image)
-        pix = self.np.zeros((self.height,self.width,2), dtype = self.np.uint8)
-        pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8),self.np.right_shift(img[...,[1]],5))
-        pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0),self.np.right_shift(img[...,[2]],3))
-        pix = pix.flatten().tolist()
-        self.SetWindows ( 0, 0, self.width, self.height)
-        self.digital_write(self.DC_PIN,True)
-        for i in range(0,len(pix),4096):
-            self.spi_writebyte(pix[i:i+4096])	
-        '''
-        self.SetWindows ( Xstart, Ystart, self.LCD_Dis_Column , self.LCD_Dis_Page  )
-        self.digital_write(self.DC_PIN,self.GPIO.HIGH)
-        # Pixels = Image.load()
-        img = np.asarray(Image)
-        pix = np.zeros((Image.height,Image.width, 2), dtype = np.uint8)
-        pix[...,[0]] = np.add(np.bitwise_and(img[...,[0]],0xF8),np.right_shift(img[...,[1]],5))
-        pix[...,[1]] = np.add(np.bitwise_and(np.left_shift(img[...,[1]],3),0xE0), np.right_shift(img[...,[2]],3))
-        pix = pix.flatten().tolist()
-        self.digital_write(self.DC_PIN,self.GPIO.HIGH)
-        for i in range(0,len(pix),4096):
-            self.spi_writebyte(pix[i:i+4096])
-        '''
+        width, height = self.panel_size()
+        _buffer = self.np.full((height, width), color, dtype = '>u2')
+        self.ShowRegion(_buffer.view(self.np.uint8).reshape(height, width, 2), 0, 0)
@@ -7,6 +7,35 @@ class LCD_2inch4(lcdconfig.RaspberryPi):
 
     width = 240
     height = 320 
+    MEMORY = (240, 320)
+    MADCTL = 0x08
+    OFFSET = (0, 0)
+    LANDSCAPE_MADCTL = lcdconfig.MADCTL_ML
+    COLMOD = {'rgb565': 0x55}        # the ILI9341 has no 12-bit mode over SPI
+    INIT = (
+        (0x11, (), 0),                    # Sleep out
+        (0xCF, (0x00, 0xC1, 0x30), 0),
+        (0xED, (0x64, 0x03, 0x12, 0x81), 0),
+        (0xE8, (0x85, 0x00, 0x79), 0),
+        (0xCB, (0x39, 0x2C, 0x00, 0x34, 0x02), 0),
+        (0xF7, (0x20,), 0),
+        (0xEA, (0x00, 0x00), 0),
+        (0xC0, (0x1D,), 0),               # Power control
+        (0xC1, (0x12,), 0),               # Power control
+        (0xC5, (0x33, 0x3F), 0),          # VCM control
+        (0xC7, (0x92,), 0),               # VCM control
+        (0x3A, None, 0),                  # set_pixel_format()
+        (0x36, None, 0),                  # set_rotation()
+        (0xB1, (0x00, 0x12), 0),
+        (0xB6, (0x0A, 0xA2), 0),          # Display Function Control
+        (0x44, (0x02,), 0),
+        (0xF2, (0x00,), 0),               # 3Gamma Function Disable
+        (0x26, (0x01,), 0),               # Gamma curve selected
+        (0xE0, (0x0F, 0x22, 0x1C, 0x1B, 0x08, 0x0F, 0x48, 0xB8, 0x34, 0x05, 0x0C, 0x09, 0x0F, 0x07, 0x00), 0),  # Set Gamma
+        (0xE1, (0x00, 0x23, 0x24, 0x07, 0x10, 0x07, 0x38, 0x47, 0x4B, 0x0A, 0x13, 0x06, 0x30, 0x38, 0x0F), 0),  # Set Gamma
+        (0x29, (), 0),                    # Display on
+    )
+
     def command(self, cmd):
         self.digital_write(self.DC_PIN, False)
         self.spi_writebyte([cmd])
@@ -22,166 +51,12 @@ class LCD_2inch4(lcdconfig.RaspberryPi):
         time.sleep(0.01)
         self.digital_write(self.RST_PIN,True)
         time.sleep(0.01)
-        
-    def Init(self):
-        """Initialize dispaly"""  
-        self.module_init()
-        self.reset()
-
-        self.command(0x11)#'''Sleep out'''
-	
-        self.command(0xCF)#
-        self.data(0x00)#
-        self.data(0xC1)#
-        self.data(0X30)#
-        self.command(0xED)#
-        self.data(0x64)#
-        self.data(0x03)#
-        self.data(0X12)#
-        self.data(0X81)#
-        self.command(0xE8)#
-        self.data(0x85)#
-        self.data(0x00)#
-        self.data(0x79)#
-        self.command(0xCB)#
-        self.data(0x39)#
-        self.data(0x2C)#
-        self.data(0x00)#
-        self.data(0x34)#
-        self.data(0x02)#
-        self.command(0xF7)#
-        self.data(0x20)#
-        self.command(0xEA)#
-        self.data(0x00)#
-        self.data(0x00)#
-        self.command(0xC0)#'''Power control'''
-        self.data(0x1D)#'''VRH[5:0]'''
-        self.command(0xC1)#'''Power control'''
-        self.data(0x12)#'''SAP[2:0]#BT[3:0]'''
-        self.command(0xC5)#'''VCM control'''
-        self.data(0x33)#
-        self.data(0x3F)#
-        self.command(0xC7)#'''VCM control'''
-        self.data(0x92)#
-        self.command(0x3A)#'''Memory Access Control'''
-        self.data(0x55)#
-        self.command(0x36)#'''Memory Access Control'''
-        self.data(0x08)#
-        self.command(0xB1)#
-        self.data(0x00)#
-        self.data(0x12)#
-        self.command(0xB6)#'''Display Function Control'''
-        self.data(0x0A)#
-        self.data(0xA2)#
-
-        self.command(0x44)#
-        self.data(0x02)#
-
-        self.command(0xF2)#'''3Gamma Function Disable'''
-        self.data(0x00)#
-        self.command(0x26)#'''Gamma curve selected'''
-        self.data(0x01)#
-        self.command(0xE0)#'''Set Gamma'''
-        self.data(0x0F)#
-        self.data(0x22)#
-        self.data(0x1C)#
-        self.data(0x1B)#
-        self.data(0x08)#
-        self.data(0x0F)#
-        self.data(0x48)#
-        self.data(0xB8)#
-        self.data(0x34)#
-        self.data(0x05)#
-        self.data(0x0C)#
-        self.data(0x09)#
-        self.data(0x0F)#
-        self.data(0x07)#
-        self.data(0x00)#
-        self.command(0XE1)#'''Set Gamma'''
-        self.data(0x00)#
-        self.data(0x23)#
-        self.data(0x24)#
-        self.data(0x07)#
-        self.data(0x10)#
-        self.data(0x07)#
-        self.data(0x38)#
-        self.data(0x47)#
-        self.data(0x4B)#
-        self.data(0x0A)#
-        self.data(0x13)#
-        self.data(0x06)#
-        self.data(0x30)#
-        self.data(0x38)#
-        self.data(0x0F)#
-        self.command(0x29)#'''Display on'''
-
-  
-    def SetWindows(self, Xstart, Ystart, Xend, Yend):
-        #set the X coordinates
-        self.command(0x2A)
-        self.data(Xstart>>8)        #Set the horizontal starting point to the high octet
-        self.data(Xstart & 0xff)    #Set the horizontal starting point to the low octet
-        self.data(Xend>>8)          #Set the horizontal end to the high octet
-        self.data((Xend - 1) & 0xff)#Set the horizontal end to the low octet 
-
-        #set the Y coordinates
-        self.command(0x2B)
-        self.data(Ystart>>8)
-        self.data((Ystart & 0xff))
-        self.data(Yend>>8)
-        self.data((Yend - 1) & 0xff )
-
-        self.command(0x2C)    
-        
-    def ShowImage(self,Image,Xstart=0,Ystart=0):
-        """Set buffer to value of Python Imaging Library image."""
-        """Write display buffer to physical display"""
-        imwidth, imheight = Image.size
-        if imwidth == self.height and imheight ==  self.width:
-            img = self.np.asarray(Image)
-            pix = self.np.zeros((imheight,imwidth , 2), dtype = self.np.uint8)
-            
-            pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8),self.np.right_shift(img[...,[1]],5))
-            pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0), self.np.right_shift(img[...,[2]],3))
-
-            pix = pix.flatten().tolist()
-            
-            self.command(0x36)
-            self.data(0x78) 
-            self.SetWindows ( 0, 0, self.width, self.height)
-            self.digital_write(self.DC_PIN,True)
-            for i in range(0,len(pix),4096):
-                self.spi_writebyte(pix[i:i+4096])
-            
-        else :
-            img = self.np.asarray(Image)
-            pix = self.np.zeros((imheight,imwidth , 2), dtype = self.np.uint8)
-            
-            pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8),self.np.right_shift(img[...,[1]],5))
-            pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0), self.np.right_shift(img[...,[2]],3))
-
-            pix = pix.flatten().tolist()
-            self.command(0x36)
-            self.data(0x08) 
-            self.SetWindows ( 0, 0, self.width, self.height)
-            self.digital_write(self.DC_PIN,True)
-            for i in range(0,len(pix),4096):
-                self.spi_writebyte(pix[i:i+4096])
-
-    def clear(self):
-        """Clear contents of image buffer"""
-        _buffer = [0xff]*(self.width * self.height * 2)
-        time.sleep(0.02)
-        self.SetWindows ( 0, 0, self.width, self.height)
-        self.digital_write(self.DC_PIN,True)
-        for i in range(0,len(_buffer),4096):
-            self.spi_writebyte(_buffer[i:i+4096])	
 
     def clear_color(self,color):
         """Clear contents of image buffer"""
-        _buffer = [color>>8, color & 0xff]*(self.width * self.height)
+        width, height = self.panel_size()
+        _buffer = self.np.full(width * height, color, dtype = '>u2')
         time.sleep(0.02)
-        self.SetWindows ( 0, 0, self.width, self.height)
+        self.SetWindows ( 0, 0, width, height)
         self.digital_write(self.DC_PIN,True)
-        for i in range(0,len(_buffer),4096):
-            self.spi_writebyte(_buffer[i:i+4096])
+        self.spi_writebuf(_buffer)
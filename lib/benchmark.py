@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# End-to-end benchmark: every step a frame takes from sct.grab() to the last
+# SPI byte, for each codec and each panel size in lib/.
+#
+#   transform  CaptureTransform of a BGRA capture at twice the panel size
+#              (a Retina grab) down to the panel
+#   encode     the --codec encoder, keyframes every KEYFRAME_EVERY frames
+#   transport  protocol.send_frame over loopback TCP, read with FrameReader
+#   decode     FrameDecoder at the panel size
+#   pack       RGB565 conversion of decoded images (rgb565 frames skip it)
+#   display    ShadowFramebuffer diff and the driver's SetWindows/ShowRegion
+#              calls, writing to a lib.virtual panel that only counts bytes
+#   spi        time the bytes written would take on the bus (lib.virtual model)
+#
+# Content is synthetic (static, scroll, video) or --images files. A
+# --recording from screen_capture.py --record is already encoded, so it runs
+# from transport onwards, on the panels of its frame size. Results are one
+# JSON document, so runs can be kept and compared across releases:
+#
+#   python3 -m lib.benchmark --frames 60 --output results.json
+#   python3 -m lib.benchmark --codec jpeg --panel LCD_2inch --content video
+#   python3 -m lib.benchmark --recording capture.mprec
+
+import argparse
+import json
+import os
+import platform
+import pkgutil
+import queue
+import socket
+import sys
+import threading
+import time
+from importlib import import_module
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from . import codec, protocol, replay, rgb565, virtual
+from .framebuffer import ShadowFramebuffer
+from .recording import Recording
+from .transform import CaptureTransform
+
+VERSION = 1
+STAGES = ('transform', 'encode', 'transport', 'decode', 'pack', 'display', 'spi')
+CONTENT = ('static', 'scroll', 'video')
+KEYFRAME_EVERY = 50
+
+def panels():
+    """One LCD_* driver class per distinct panel size, by module name"""
+    import lib
+    found = {}
+    for info in sorted(pkgutil.iter_modules(lib.__path__), key = lambda m: m.name):
+        if not info.name.startswith('LCD_'):
+            continue
+        cls = getattr(import_module('lib.' + info.name), info.name)
+        found.setdefault((cls.width, cls.height), cls)
+    return {cls.__name__: cls for cls in found.values()}
+
+class Content(object):
+    """BGRA captures of width x height, frame by frame.
+
+    static repeats one screen of text-like blocks, scroll moves it up by a
+    few rows per frame, video is moving gradients with noise. images cycles
+    through the given BGRA arrays.
+    """
+
+    def __init__(self, kind, width, height, images = None, seed = 1):
+        self.kind = kind
+        self.width = width
+        self.height = height
+        rng = np.random.default_rng(seed)
+        if kind == 'images':
+            self.images = images
+        elif kind in ('static', 'scroll'):
+            # Dark "glyphs" on white, on a text-like grid of 8 x 16 px cells
+            cells = rng.random(((2 * height) // 16 + 1, width // 8 + 1)) < 0.4
+            ink = np.kron(cells, np.ones((16, 8), dtype = bool))[:, :width]
+            ink[:, 6::8] = False
+            ink[12::16] = False
+            page = np.where(ink[..., None], np.uint8(30), np.uint8(240)).repeat(4, axis = 2)
+            self.page = np.ascontiguousarray(page)
+        else:
+            y, x = np.mgrid[0:height, 0:width]
+            self.x = x / width
+            self.y = y / height
+            self.noise = rng.integers(0, 24, (height, width), dtype = np.uint8)
+
+    def frame(self, index):
+        if self.kind == 'images':
+            return self.images[index % len(self.images)]
+        if self.kind == 'static':
+            return self.page[:self.height]
+        if self.kind == 'scroll':
+            top = (index * 4) % (len(self.page) - self.height)
+            return self.page[top:top + self.height]
+        t = index / 10.0
+        bgra = np.empty((self.height, self.width, 4), dtype = np.uint8)
+        bgra[..., 0] = 127 + 100 * np.sin(2 * np.pi * (self.x + t))
+        bgra[..., 1] = 127 + 100 * np.sin(2 * np.pi * (self.y - t / 2))
+        bgra[..., 2] = 127 + 100 * np.sin(2 * np.pi * (self.x + self.y + t / 3))
+        bgra[..., :3] += self.noise[..., None]
+        bgra[..., 3] = 255
+        return bgra
+
+def load_images(paths, width, height):
+    """Files as BGRA captures of width x height"""
+    images = []
+    for path in paths:
+        rgba = np.asarray(Image.open(path).convert('RGBA').resize((width, height), Image.BILINEAR))
+        images.append(np.ascontiguousarray(rgba[..., [2, 1, 0, 3]]))
+    return images
+
+class Loopback(object):
+    """A TCP connection to ourselves; sending runs on a thread so big frames cannot deadlock"""
+
+    def __init__(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.client = socket.create_connection(server.getsockname())
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn, _ = server.accept()
+        server.close()
+        self.reader = protocol.FrameReader(self.conn)
+        self.outgoing = queue.Queue()
+        self.thread = threading.Thread(target = self._send, name = 'sender')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _send(self):
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            if isinstance(item, tuple):
+                protocol.send_frame(self.client, *item)
+            else:
+                self.client.sendall(item)
+
+    def transfer(self, frame_type, payload, codec_id, width, height, seq):
+        """Send one frame and read it back; returns (header, payload view)"""
+        self.outgoing.put((frame_type, payload, codec_id, width, height, seq))
+        return self.reader.read()
+
+    def transfer_bytes(self, frame):
+        """Send one frame that is already in wire format (a recorded one) and read it back"""
+        self.outgoing.put(frame)
+        return self.reader.read()
+
+    def close(self):
+        self.outgoing.put(None)
+        self.thread.join()
+        self.client.close()
+        self.conn.close()
+
+class Receiver(object):
+    """The Pi's side: FrameDecoder, RGB565 packing and the driver on a byte-counting virtual panel"""
+
+    def __init__(self, cls, spi_hz = None):
+        self.display = virtual.make_display(cls, spi_hz = spi_hz, decode = False)
+        self.display.Init()
+        self.decoder = codec.FrameDecoder((self.display.width, self.display.height))
+        self.shadow = ShadowFramebuffer(self.display)
+        self.packer = rgb565.RGB565()
+        self.spi_bytes = []
+
+    def set_rotation(self, rotation):
+        """SET_ROTATION as screen_stream.py handles it; unsupported angles are ignored"""
+        try:
+            self.display.set_rotation(rotation)
+        except ValueError:
+            return
+        self.shadow.invalidate()
+
+    def show(self, header, payload, times):
+        """Decode, pack and display one frame, appending the decode to spi stage times"""
+        panel = self.display.panel
+        start = time.perf_counter()
+        decoded = self.decoder.decode(header, payload)
+        times['decode'].append(time.perf_counter() - start)
+        if decoded is None:
+            self._skip(times, 'pack')
+            return
+        kind, image = decoded
+
+        start = time.perf_counter()
+        pix = image if kind == 'rgb565' else self.packer.pack(image)
+        times['pack'].append(time.perf_counter() - start if kind != 'rgb565' else 0.0)
+
+        bus_seconds, bus_bytes = panel.seconds(), panel.counters['bytes']
+        start = time.perf_counter()
+        # As screen_stream.py: the panel turns for frames of its size swapped
+        # and skips frames made for another panel
+        height, width = pix.shape[:2]
+        if self.display.match_orientation(width, height):
+            self.shadow.invalidate()
+        if (width, height) != self.display.panel_size():
+            times['display'].append(time.perf_counter() - start)
+            times['spi'].append(panel.seconds() - bus_seconds)
+            self.spi_bytes.append(panel.counters['bytes'] - bus_bytes)
+            return
+        self.shadow.show_packed(pix)
+        times['display'].append(time.perf_counter() - start)
+        times['spi'].append(panel.seconds() - bus_seconds)
+        self.spi_bytes.append(panel.counters['bytes'] - bus_bytes)
+
+    def _skip(self, times, first):
+        for stage in STAGES[STAGES.index(first):]:
+            times[stage].append(0.0)
+        self.spi_bytes.append(0)
+
+def run(cls, codec_name, content, frames = 30, quality = 50, use_lz4 = False, images = None, spi_hz = None):
+    """Push frames through every stage for one panel, codec and content; returns a result dict"""
+    receiver = Receiver(cls, spi_hz)
+    width, height = receiver.display.width, receiver.display.height
+    capture_width, capture_height = width * 2, height * 2
+    source = Content(content, capture_width, capture_height, images)
+    output = 'rgb565' if codec_name == 'rgb565' else 'rgb'
+    transform = CaptureTransform(capture_width, capture_height, 0, width, height, 'auto', output)
+    encoder = codec.make_codec(codec_name, quality, use_lz4)
+    link = Loopback()
+
+    times = {stage: [] for stage in STAGES}
+    wire_bytes = []
+    try:
+        for i in range(frames):
+            raw = source.frame(i)
+
+            start = time.perf_counter()
+            frame, order = transform(raw)
+            times['transform'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            encoded = encoder.encode(frame, i % KEYFRAME_EVERY == 0, order)
+            times['encode'].append(time.perf_counter() - start)
+            wire_bytes.append(len(encoded.payload))
+
+            start = time.perf_counter()
+            header, payload = link.transfer(encoded.frame_type, encoded.payload, encoded.codec,
+                                            frame.shape[1], frame.shape[0], i)
+            elapsed = time.perf_counter() - start
+            times['transport'].append(elapsed)
+            encoder.record_send(len(encoded.payload), elapsed)
+
+            receiver.show(header, payload, times)
+    finally:
+        link.close()
+    return _result(cls, receiver, codec_name, content, times, wire_bytes)
+
+def run_recording(cls, recording, frames = None, spi_hz = None):
+    """Push a recording's frames through the stages from transport on; returns a result dict
+
+    The recorded frames are already encoded, so there is no transform or
+    encode stage. Rotation control frames are applied as screen_stream.py
+    would.
+    """
+    receiver = Receiver(cls, spi_hz)
+    link = Loopback()
+    times = {stage: [] for stage in STAGES[2:]}
+    wire_bytes = []
+    codecs = set()
+    try:
+        for i, header, payload in recording.frames():
+            if header.type == protocol.FRAME_CONTROL and payload and payload[0] == protocol.CONTROL_SET_ROTATION:
+                receiver.set_rotation(protocol.parse_rotation(payload))
+                continue
+            if header.type not in replay.FRAMES:
+                continue
+            if len(wire_bytes) == frames:
+                break
+            codecs.add(replay.CODEC_NAMES.get(header.codec, str(header.codec)))
+            wire_bytes.append(header.length)
+
+            start = time.perf_counter()
+            header, payload = link.transfer_bytes(recording.frame(i))
+            times['transport'].append(time.perf_counter() - start)
+
+            receiver.show(header, payload, times)
+    finally:
+        link.close()
+    return _result(cls, receiver, ', '.join(sorted(codecs)), os.path.basename(recording.path), times, wire_bytes)
+
+def recording_sizes(recording):
+    """(width, height) of the frames in a recording"""
+    return set((header.width, header.height) for _, header, _ in recording.frames(replay.FRAMES))
+
+def _result(cls, receiver, codec_name, content, times, wire_bytes):
+    # Capture/transform, encode, send and the Pi's reader, decoder and
+    # display threads all overlap, so the slowest of them sets the rate
+    threads = [times[stage] for stage in ('transform', 'encode', 'transport', 'decode') if stage in times]
+    threads.append(np.add(np.add(times['pack'], times['display']), times['spi']))
+    latency = np.sum(list(times.values()), axis = 0)
+    return {
+        'panel': cls.__name__,
+        'width': receiver.display.width,
+        'height': receiver.display.height,
+        'codec': codec_name,
+        'content': content,
+        'frames': len(wire_bytes),
+        'fps': round(1.0 / max(np.mean(t) for t in threads), 2),
+        'latency_ms': _summary(latency),
+        'stages_ms': {stage: _summary(t) for stage, t in times.items()},
+        'wire_bytes': float(np.mean(wire_bytes)),
+        'spi_bytes': float(np.mean(receiver.spi_bytes)),
+    }
+
+def _summary(seconds):
+    ms = np.asarray(seconds, dtype = float) * 1000
+    return {
+        'p50': round(float(np.percentile(ms, 50)), 4),
+        'p99': round(float(np.percentile(ms, 99)), 4),
+        'mean': round(float(ms.mean()), 4),
+    }
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+def _report(result):
+    """Print one result line to stderr; returns result"""
+    stages = ', '.join('{0} {1:.2f}'.format(stage, t['p50']) for stage, t in result['stages_ms'].items())
+    print('{panel} {width}x{height} {codec} {content}: {fps:.1f} fps, latency p50 {p50:.1f} ms '
+          'p99 {p99:.1f} ms, {wire:.0f} B/frame on the wire; p50 ms: {stages}'.format(
+              p50 = result['latency_ms']['p50'], p99 = result['latency_ms']['p99'],
+              wire = result['wire_bytes'], stages = stages, **result), file = sys.stderr)
+    return result
+
+def main(argv = None):
+    all_panels = panels()
+    parser = argparse.ArgumentParser(description = 'Time every stage from capture to SPI for each codec and panel.')
+    parser.add_argument('--codec', action = 'append', choices = codec.CODECS,
+                        help = 'Codec to run; repeat for several (default: all)')
+    parser.add_argument('--panel', action = 'append', choices = sorted(all_panels),
+                        help = 'Panel driver to run; repeat for several (default: one per panel size)')
+    parser.add_argument('--content', action = 'append', choices = CONTENT + ('images',),
+                        help = 'Synthetic content to run; repeat for several (default: all synthetic, '
+                               'or images when --images is given)')
+    parser.add_argument('--images', nargs = '+', default = [], help = 'Image files to use as captured content')
+    parser.add_argument('--recording', nargs = '+', default = [],
+                        help = 'screen_capture.py --record files to run from the wire onwards; only these are run '
+                               'unless synthetic content or codecs are asked for too')
+    parser.add_argument('--frames', type = int, default = None,
+                        help = 'Frames per run (default: 30, or every frame of a recording)')
+    parser.add_argument('--quality', type = int, default = 50, help = 'JPEG quality (default: 50)')
+    parser.add_argument('--lz4', action = 'store_true', help = 'Compress rgb565 frames with lz4')
+    parser.add_argument('--spi-hz', type = float, default = None,
+                        help = 'SPI clock for the bus model (default: the driver\'s, 40 MHz)')
+    parser.add_argument('--output', help = 'Write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    contents = args.content or (['images'] if args.images else list(CONTENT))
+    if 'images' in contents and not args.images:
+        parser.error('--content images needs --images')
+    results = []
+    for path in args.recording:
+        with Recording(path) as recording:
+            # By default the panels the recording was made for
+            sizes = recording_sizes(recording)
+            names = args.panel or [name for name, cls in sorted(all_panels.items())
+                                   if (cls.width, cls.height) in sizes or (cls.height, cls.width) in sizes]
+            for name in names or sorted(all_panels):
+                results.append(_report(run_recording(all_panels[name], recording, args.frames, args.spi_hz)))
+    if not args.recording or args.codec or args.content or args.images:
+        for name in args.panel or sorted(all_panels):
+            cls = all_panels[name]
+            images = load_images(args.images, cls.width * 2, cls.height * 2) if args.images else None
+            for codec_name in args.codec or codec.CODECS:
+                for content in contents:
+                    results.append(_report(run(cls, codec_name, content, args.frames or 30, args.quality,
+                                               args.lz4, images, args.spi_hz)))
+
+    document = {
+        'version': VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': {
+            'frames': args.frames,
+            'quality': args.quality,
+            'lz4': args.lz4,
+            'spi_hz': args.spi_hz or virtual.SPI_HZ,
+            'keyframe_every': KEYFRAME_EVERY,
+            'images': args.images,
+            'recordings': args.recording,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent = 2)
+    else:
+        json.dump(document, sys.stdout, indent = 2)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+# Frame codecs shared by screen_capture.py (encode) and screen_stream.py (decode).
+#
+#   jpeg    lossy, best for video and photos
+#   png     lossless, good for static text and UI
+#   rgb565  lossless panel-native pixels; the Pi only decompresses and
+#           writes them to SPI. lz4 is optional (pip3 install lz4, needed
+#           on both ends); zlib at level 1 is the fallback.
+#   tiles   changed tiles since the previous frame (lib.tiles), with a
+#           keyframe from another codec when needed
+#   auto    picks one of the above per frame from measured encode time,
+#           payload size and link bandwidth
+#
+# Encoders take an HxWx3/HxWx4 uint8 array plus the channel order of red,
+# green and blue in it (rgb565.RGB or rgb565.BGR for an mss capture).
+# The rgb565 codec also takes an HxWx2 array that is already packed.
+
+import math
+import time
+import zlib
+from collections import namedtuple
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from . import protocol
+from . import rgb565
+from . import tiles
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODECS = ('auto', 'jpeg', 'png', 'rgb565', 'tiles')
+
+Encoded = namedtuple('Encoded', 'frame_type codec payload')
+
+def _rgb(frame, order):
+    """frame as an HxWx3 RGB array (a copy only if it needs reordering)"""
+    if tuple(order) == rgb565.RGB and frame.shape[2] == 3:
+        return frame
+    return frame[..., list(order)]
+
+def encode_rgb565(pix, use_lz4 = False):
+    """Compress an HxWx2 RGB565 array; returns (codec id, payload)"""
+    data = memoryview(np.ascontiguousarray(pix)).cast('B')
+    if use_lz4:
+        if lz4 is None:
+            raise RuntimeError('lz4 is not installed (pip3 install lz4)')
+        return protocol.CODEC_RGB565_LZ4, lz4.frame.compress(data)
+    return protocol.CODEC_RGB565_ZLIB, zlib.compress(data, 1)
+
+def decode_rgb565(codec, payload, width, height):
+    """Decompress a payload from encode_rgb565 into a read-only HxWx2 array (no copy)"""
+    if codec == protocol.CODEC_RGB565_LZ4:
+        if lz4 is None:
+            raise RuntimeError('lz4 is not installed (pip3 install lz4)')
+        data = lz4.frame.decompress(payload)
+    elif codec == protocol.CODEC_RGB565_ZLIB:
+        data = zlib.decompress(payload)
+    else:
+        raise ValueError('Not an RGB565 codec: {0}'.format(codec))
+    if len(data) != width * height * 2:
+        raise ValueError('RGB565 frame is {0} bytes, expected {1}x{2}'.format(len(data), width, height))
+    return np.frombuffer(data, dtype = np.uint8).reshape(height, width, 2)
+
+class Codec(object):
+    """Base class; every encode() result is a keyframe unless noted"""
+    name = None
+    lossless = False
+
+    def encode(self, frame, keyframe = False, order = rgb565.RGB):
+        raise NotImplementedError
+
+    def record_send(self, nbytes, seconds):
+        """Told how long sending each payload took; used by AutoCodec"""
+
+    def set_quality(self, quality):
+        """Change the JPEG quality of this codec and any it uses; no-op for lossless ones"""
+
+class JpegCodec(Codec):
+    name = 'jpeg'
+
+    def __init__(self, quality = 50):
+        self.quality = quality
+
+    def set_quality(self, quality):
+        self.quality = quality
+
+    def encode(self, frame, keyframe = False, order = rgb565.RGB):
+        buffer = BytesIO()
+        Image.fromarray(_rgb(frame, order)).save(buffer, format = 'JPEG', quality = self.quality, subsampling = 0)
+        return Encoded(protocol.FRAME_KEYFRAME, protocol.CODEC_JPEG, buffer.getvalue())
+
+class PngCodec(Codec):
+    name = 'png'
+    lossless = True
+
+    def encode(self, frame, keyframe = False, order = rgb565.RGB):
+        buffer = BytesIO()
+        Image.fromarray(_rgb(frame, order)).save(buffer, format = 'PNG', compress_level = 1)
+        return Encoded(protocol.FRAME_KEYFRAME, protocol.CODEC_PNG, buffer.getvalue())
+
+class Rgb565Codec(Codec):
+    name = 'rgb565'
+    lossless = True
+
+    def __init__(self, use_lz4 = False):
+        self.use_lz4 = use_lz4
+        self.packer = rgb565.RGB565()
+
+    def encode(self, frame, keyframe = False, order = rgb565.RGB):
+        # Frames from transform.CaptureTransform(output = 'rgb565') are already packed
+        pix = frame if frame.shape[2] == 2 else self.packer.pack(frame, order)
+        codec, payload = encode_rgb565(pix, self.use_lz4)
+        return Encoded(protocol.FRAME_KEYFRAME, codec, payload)
+
+class TileCodec(Codec):
+    """Changed tiles against the previous frame; keyframes come from keyframe_codec.
+
+    Falls back to a keyframe when more than max_dirty of the frame changed,
+    since a full frame then compresses better than the tiles.
+    """
+    name = 'tiles'
+    lossless = True
+
+    def __init__(self, keyframe_codec, tile_size = tiles.TILE_SIZE, max_dirty = 0.5):
+        self.keyframe_codec = keyframe_codec
+        self.tiles = tiles.TileEncoder(tile_size)
+        self.max_dirty = max_dirty
+
+    def set_quality(self, quality):
+        self.keyframe_codec.set_quality(quality)
+
+    def encode(self, frame, keyframe = False, order = rgb565.RGB):
+        delta = self.tiles.encode(frame, keyframe, order, self.max_dirty)
+        if delta is None:
+            return self.keyframe_codec.encode(frame, True, order)
+        return Encoded(protocol.FRAME_DELTA, protocol.CODEC_TILES_ZLIB, zlib.compress(delta, 1))
+
+class AutoCodec(Codec):
+    """Chooses a codec per frame to minimise encode time + transmit time.
+
+    Tile deltas are tried first whenever a delta is allowed and are kept if
+    they beat the best keyframe estimate. Otherwise the keyframe codec with
+    the lowest expected cost is used; lossless codecs win ties within
+    lossless_bias. Each codec's encode time and payload size, and the link
+    bandwidth, are tracked as moving averages. Every explore_every keyframes
+    the codec with the oldest measurement is re-tried so the estimates
+    follow the content.
+    """
+    name = 'auto'
+
+    def __init__(self, quality = 50, use_lz4 = False, tile_size = tiles.TILE_SIZE,
+                 bandwidth = 2000000, lossless_bias = 1.25, explore_every = 30, max_dirty = 0.5):
+        self.keyframe_codecs = [JpegCodec(quality), PngCodec(), Rgb565Codec(use_lz4)]
+        self.tiles = tiles.TileEncoder(tile_size)
+        self.max_dirty = max_dirty
+        self.bandwidth = float(bandwidth)       # bytes per second
+        self.lossless_bias = lossless_bias
+        self.explore_every = explore_every
+        self.estimates = {}                     # name -> [encode seconds, payload bytes, keyframe no.]
+        self.keyframes = 0
+        self.last = None
+
+    def set_quality(self, quality):
+        for c in self.keyframe_codecs:
+            c.set_quality(quality)
+
+    def cost(self, name):
+        seconds, nbytes, _ = self.estimates[name]
+        return seconds + nbytes / self.bandwidth
+
+    def _measure(self, name, seconds, nbytes):
+        est = self.estimates.get(name)
+        if est is None:
+            self.estimates[name] = [seconds, nbytes, self.keyframes]
+        else:
+            est[0] += (seconds - est[0]) * 0.2
+            est[1] += (nbytes - est[1]) * 0.2
+            est[2] = self.keyframes
+
+    def choose_keyframe_codec(self):
+        unmeasured = [c for c in self.keyframe_codecs if c.name not in self.estimates]
+        if unmeasured:
+            return unmeasured[0]
+        if self.keyframes % self.explore_every == 0:
+            return min(self.keyframe_codecs, key = lambda c: self.estimates[c.name][2])
+        best = min(self.keyframe_codecs, key = lambda c: self.cost(c.name))
+        if best.lossless:
+            return best
+        limit = self.cost(best.name) * self.lossless_bias
+        lossless = [c for c in self.keyframe_codecs if c.lossless and self.cost(c.name) <= limit]
+        return min(lossless, key = lambda c: self.cost(c.name)) if lossless else best
+
+    def encode(self, frame, keyframe = False, order = rgb565.RGB):
+        start = time.perf_counter()
+        delta = self.tiles.encode(frame, keyframe, order, self.max_dirty)
+        if delta is not None:
+            payload = zlib.compress(delta, 1)
+            seconds = time.perf_counter() - start
+            self._measure('tiles', seconds, len(payload))
+            best = min((self.cost(c.name) for c in self.keyframe_codecs if c.name in self.estimates),
+                       default = None)
+            if best is None or seconds + len(payload) / self.bandwidth <= best:
+                self.last = 'tiles'
+                return Encoded(protocol.FRAME_DELTA, protocol.CODEC_TILES_ZLIB, payload)
+
+        codec = self.choose_keyframe_codec()
+        self.keyframes += 1
+        start = time.perf_counter()
+        encoded = codec.encode(frame, True, order)
+        self._measure(codec.name, time.perf_counter() - start, len(encoded.payload))
+        self.last = codec.name
+        return encoded
+
+    def record_send(self, nbytes, seconds):
+        # Only frames big enough to fill the socket buffer say anything about the link
+        if nbytes >= 16384 and seconds > 0.001:
+            self.bandwidth += (nbytes / seconds - self.bandwidth) * 0.2
+
+def make_codec(name, quality = 50, use_lz4 = False, tile_size = tiles.TILE_SIZE):
+    """Build the sender codec for a --codec name"""
+    if name == 'auto':
+        return AutoCodec(quality, use_lz4, tile_size)
+    if name == 'jpeg':
+        return JpegCodec(quality)
+    if name == 'png':
+        return PngCodec()
+    if name == 'rgb565':
+        return Rgb565Codec(use_lz4)
+    if name == 'tiles':
+        return TileCodec(JpegCodec(quality), tile_size)
+    raise ValueError('Unknown codec {0!r}, expected one of {1}'.format(name, ', '.join(CODECS)))
+
+class FrameDecoder(object):
+    """Receiver side: turns any frame into something the display can show.
+
+    decode() returns ('image', PIL image), ('rgb565', HxWx2 array) or None
+    when there is nothing to show (empty delta, or a delta before any
+    keyframe). The last keyframe is kept so tile deltas can be composited
+    onto it whatever codec it came in.
+
+    With size = (width, height) of the panel, images come out at exactly
+    the panel size in whichever orientation matches the frame: JPEGs are
+    decoded straight to about the panel size with libjpeg's DCT scaling
+    (Image.draft) and anything else that does not fit is scaled and
+    letterboxed. RGB565 frames of the wrong size are converted to images
+    and fitted the same way.
+    """
+
+    def __init__(self, size = None):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.canvas = None          # HxWx3 RGB of the last frame, if known
+        self.packed = None          # last rgb565 keyframe, unpacked only if a delta needs it
+        self.jpeg = None            # last JPEG keyframe, decoded full size only if a delta needs it
+
+    def panel_size(self, width, height):
+        """Panel (width, height) in the orientation of a width x height frame"""
+        w, h = self.size
+        if (width > height) != (w > h):
+            w, h = h, w
+        return w, h
+
+    def fits(self, width, height):
+        return self.size is None or self.panel_size(width, height) == (width, height)
+
+    def fit(self, image):
+        """Scale image to fit the panel keeping its aspect ratio, letterboxed in black"""
+        if self.fits(*image.size):
+            return image
+        w, h = self.panel_size(*image.size)
+        scale = min(w / image.width, h / image.height)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        if size != image.size:
+            image = image.resize(size, Image.BILINEAR)
+        if size == (w, h):
+            return image
+        boxed = Image.new('RGB', (w, h))
+        boxed.paste(image, ((w - size[0]) // 2, (h - size[1]) // 2))
+        return boxed
+
+    def decode(self, header, payload):
+        """payload may be a view into a buffer the caller reuses; nothing keeps a reference to it"""
+        codec = header.codec
+        if codec in (protocol.CODEC_RGB565_ZLIB, protocol.CODEC_RGB565_LZ4):
+            pix = decode_rgb565(codec, payload, header.width, header.height)
+            self.canvas, self.packed, self.jpeg = None, pix, None
+            if not self.fits(header.width, header.height):
+                return 'image', self.fit(Image.fromarray(rgb565.unpack(pix)))
+            return 'rgb565', pix
+
+        if codec == protocol.CODEC_TILES_ZLIB:
+            payload = zlib.decompress(payload)
+            if self.canvas is None:
+                if self.packed is not None:
+                    self.canvas = rgb565.unpack(self.packed)
+                elif self.jpeg is not None:
+                    self.canvas = np.array(Image.open(BytesIO(self.jpeg)).convert('RGB'))
+                else:
+                    return None
+                self.packed = self.jpeg = None
+            if not tiles.apply_delta(self.canvas, payload):
+                return None
+            return 'image', self.fit(Image.fromarray(self.canvas))
+
+        if codec == protocol.CODEC_JPEG_ZLIB:
+            payload = zlib.decompress(payload)
+            codec = protocol.CODEC_JPEG
+        elif codec not in (protocol.CODEC_JPEG, protocol.CODEC_PNG):
+            raise ValueError('Unsupported codec {0}'.format(codec))
+        image = Image.open(BytesIO(payload))
+        if codec == protocol.CODEC_JPEG:
+            # Deltas need the full-size frame, so that is only decoded when one arrives
+            self.canvas, self.packed, self.jpeg = None, None, bytes(payload)
+            if self.size is not None:
+                w, h = self.panel_size(*image.size)
+                scale = min(w / image.width, h / image.height)
+                image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            image = image.convert('RGB')
+        else:
+            image = image.convert('RGB')
+            self.canvas, self.packed, self.jpeg = np.array(image), None, None
+        return 'image', self.fit(image)
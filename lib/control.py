@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# Adaptive frame rate / quality control for screen_capture.py, driven by the
+# acks the Pi sends back for every frame (see protocol.CONTROL_ACK).
+#
+# Once per window the controller compares what the Pi actually displayed
+# with what was asked for. If frames take longer than target_latency from
+# capture to glass, or captures keep being skipped because the Pi has not
+# caught up, it backs off one step; after a few clean windows in a row it
+# undoes one step. Backing off goes:
+#
+#   the Pi is busy for most of each frame period  ->  lower the frame rate
+#   otherwise (the network is the bottleneck)      ->  lower JPEG quality,
+#       then stop preferring lossless codecs (auto), then shrink the frame,
+#       then lower the frame rate
+#
+# and recovery goes the other way round.
+
+import time
+
+class AdaptiveController(object):
+    """Adjusts rate, JPEG quality, codec preference and scale of a SendPipeline.
+
+    encoder is the pipeline's codec; rate and quality are the requested
+    (and maximum) values. scalable says whether frames may be sent smaller
+    than the panel, which only works for codecs whose keyframes are images
+    the Pi can resize. Every decision is passed to log() as one line; the
+    current settings and measurements are in state().
+    """
+
+    def __init__(self, encoder, rate, quality, scalable = True, target_latency = None,
+                 window = 1.0, min_rate = 2.0, min_quality = 20, min_scale = 0.5,
+                 recover_after = 3, log = None):
+        self.encoder = encoder
+        self.max_rate = float(rate)
+        self.max_quality = quality
+        self.scalable = scalable
+        self.target_latency = target_latency or max(2.0 / rate, 0.1)
+        self.window = window
+        self.min_rate = min(min_rate, self.max_rate)
+        self.min_quality = min(min_quality, quality)
+        self.min_scale = min_scale
+        self.recover_after = recover_after
+        self.log = log
+
+        self.rate = self.max_rate
+        self.quality = quality
+        self.scale = 1.0
+        self.prefer_lossy = False
+        self.lossless_bias = getattr(encoder, 'lossless_bias', None)
+
+        self.window_start = None
+        self.displayed = 0
+        self.skips = 0
+        self.clean_windows = 0
+        self.fps = None
+        self.latency = None
+        self.pi_busy = None
+        self.decisions = 0
+
+    def state(self):
+        return {
+            'rate': self.rate,
+            'quality': self.quality,
+            'scale': self.scale,
+            'prefer_lossy': self.prefer_lossy,
+            'fps': self.fps,
+            'latency': self.latency,
+            'pi_busy': self.pi_busy,
+            'decisions': self.decisions,
+        }
+
+    def update(self, pipeline):
+        """Measure the last window and adjust once it is over; returns the decision or None"""
+        now = time.perf_counter()
+        counters = pipeline.counters
+        if self.window_start is None:
+            self._start_window(now, counters)
+            return None
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return None
+
+        self.fps = (counters['displayed'] - self.displayed) / elapsed
+        skipped = counters['in_flight_skips'] - self.skips
+        self.latency = pipeline.latency
+        self.pi_busy = pipeline.pi_time * self.rate if pipeline.pi_time is not None else None
+        self._start_window(now, counters)
+        if not self.fps:
+            # Nothing shown (idle screen): no news about the link
+            return None
+
+        if self.latency is not None and self.latency > self.target_latency:
+            reason = 'latency {0:.0f} ms > {1:.0f} ms'.format(self.latency * 1000, self.target_latency * 1000)
+        elif skipped and self.fps < self.rate * 0.9:
+            reason = '{0:.1f} fps displayed of {1:.1f}'.format(self.fps, self.rate)
+        else:
+            reason = None
+
+        if reason is not None:
+            self.clean_windows = 0
+            change = self._back_off()
+        else:
+            self.clean_windows += 1
+            if self.clean_windows < self.recover_after:
+                return None
+            self.clean_windows = 0
+            change = self._recover()
+            reason = 'clear for {0} s'.format(self.recover_after * self.window)
+
+        if change is None:
+            return None
+        pipeline.pacer.rate = self.rate
+        self.decisions += 1
+        decision = 'Controller: {0}: {1}'.format(reason, change)
+        if self.log is not None:
+            self.log(decision)
+        return decision
+
+    def _start_window(self, now, counters):
+        self.window_start = now
+        self.displayed = counters['displayed']
+        self.skips = counters['in_flight_skips']
+
+    def _back_off(self):
+        if self.pi_busy is not None and self.pi_busy > 0.9:
+            return self._set_rate(self.rate * 0.75)
+        if self.quality > self.min_quality:
+            return self._set_quality(max(self.min_quality, self.quality - 10))
+        if self.lossless_bias is not None and not self.prefer_lossy:
+            return self._set_prefer_lossy(True)
+        if self.scalable and self.scale > self.min_scale:
+            return self._set_scale(max(self.min_scale, self.scale * 0.75))
+        return self._set_rate(self.rate * 0.75)
+
+    def _recover(self):
+        if self.rate < self.max_rate:
+            return self._set_rate(self.rate * 1.25)
+        if self.scale < 1.0:
+            return self._set_scale(min(1.0, self.scale / 0.75))
+        if self.prefer_lossy:
+            return self._set_prefer_lossy(False)
+        if self.quality < self.max_quality:
+            return self._set_quality(min(self.max_quality, self.quality + 5))
+        return None
+
+    def _set_rate(self, rate):
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        if rate == self.rate:
+            return None
+        change = 'rate {0:.1f} -> {1:.1f} fps'.format(self.rate, rate)
+        self.rate = rate
+        return change
+
+    def _set_quality(self, quality):
+        change = 'quality {0} -> {1}'.format(self.quality, quality)
+        self.quality = quality
+        self.encoder.set_quality(quality)
+        return change
+
+    def _set_prefer_lossy(self, prefer_lossy):
+        self.prefer_lossy = prefer_lossy
+        self.encoder.lossless_bias = 1.0 if prefer_lossy else self.lossless_bias
+        return 'lossless codecs ' + ('no longer preferred' if prefer_lossy else 'preferred again')
+
+    def _set_scale(self, scale):
+        change = 'scale {0:.2f} -> {1:.2f}'.format(self.scale, scale)
+        self.scale = scale
+        return change
+
+def can_scale(codec_name):
+    """Whether frames from this --codec may be smaller than the panel (the Pi resizes images)"""
+    return codec_name in ('jpeg', 'png', 'tiles')
+
+def scaled_size(width, height, scale):
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
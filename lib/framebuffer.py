@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# Shadow copy of the panel contents so only changed pixels go over SPI.
+
+import numpy as np
+from . import rgb565
+
+# What one extra SetWindows costs, expressed in pixel bytes. A window is
+# 5 transfers (three commands, two 4-byte parameter blocks), each a separate
+# spidev syscall plus a DC toggle; at 40 MHz that takes about as long as
+# ~1 KB of pixel data.
+WINDOW_COST = 1024
+
+class ShadowFramebuffer(object):
+    """Tracks what is on the display in RGB565 and pushes only the differences.
+
+    Each new frame is compared with the shadow copy, changed rows are grouped
+    into bands, each band is trimmed to its changed columns, and neighbouring
+    bands are merged whenever the extra unchanged pixels cost less than
+    another SetWindows. Identical frames send nothing.
+    """
+
+    def __init__(self, display, window_cost = WINDOW_COST):
+        self.display = display
+        self.window_cost = window_cost
+        self.rgb565 = rgb565.RGB565()
+        self.shadow = None
+        self._diff = None
+        self.frames = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0
+        self.last = None
+
+    def invalidate(self):
+        """Forget the shadow copy; the next frame is written in full"""
+        self.shadow = None
+
+    def show(self, image):
+        """Display a PIL image, sending only what changed since the last frame"""
+        pix = self.rgb565.pack(image)
+        if self.shadow is None or self.shadow.shape != pix.shape[:2]:
+            # Already packed: ShowImage() only turns the panel if needed and writes it
+            self.display.ShowImage(pix)
+            return self._full(pix)
+        return self._update(pix)
+
+    def show_packed(self, pix):
+        """Same as show() for an HxWx2 RGB565 array in the display's current orientation"""
+        if self.shadow is None or self.shadow.shape != pix.shape[:2]:
+            self.display.ShowRegion(pix, 0, 0)
+            return self._full(pix)
+        return self._update(pix)
+
+    def _full(self, pix):
+        height, width = pix.shape[:2]
+        self.shadow = pix.view(np.uint16)[..., 0].copy()
+        self._diff = np.empty((height, width), dtype = bool)
+        return self._account([(0, 0, width, height)], width * height)
+
+    def _update(self, pix):
+        cur = pix.view(np.uint16)[..., 0]
+        diff = np.not_equal(cur, self.shadow, out = self._diff)
+        rects = self.dirty_rects(diff)
+        if self.display.pixel_format == 'rgb444':
+            rects = [_even(rect, *diff.shape) for rect in rects]
+        for x0, y0, x1, y1 in rects:
+            self.display.ShowRegion(pix[y0:y1, x0:x1], x0, y0)
+            self.shadow[y0:y1, x0:x1] = cur[y0:y1, x0:x1]
+        return self._account(rects, pix.shape[0] * pix.shape[1])
+
+    def dirty_rects(self, diff):
+        """Cover the True pixels of diff with a few (x0, y0, x1, y1) rectangles"""
+        rows = np.flatnonzero(diff.any(axis = 1))
+        if rows.size == 0:
+            return []
+
+        # Runs of consecutive changed rows
+        breaks = np.flatnonzero(np.diff(rows) > 1)
+        starts = np.concatenate(([rows[0]], rows[breaks + 1]))
+        ends = np.concatenate((rows[breaks], [rows[-1]])) + 1
+
+        rects = []
+        for y0, y1 in zip(starts.tolist(), ends.tolist()):
+            cols = np.flatnonzero(diff[y0:y1].any(axis = 0))
+            rect = (int(cols[0]), y0, int(cols[-1]) + 1, y1)
+            if rects:
+                merged = self._merge(rects[-1], rect)
+                if merged is not None:
+                    rects[-1] = merged
+                    continue
+            rects.append(rect)
+        return rects
+
+    def _merge(self, a, b):
+        """Bounding box of a and b if sending it is cheaper than two windows"""
+        box = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+        if _area(box) * 2 <= (_area(a) + _area(b)) * 2 + self.window_cost:
+            return box
+        return None
+
+    def _account(self, rects, full_pixels):
+        # Counted in the display's pixel format (RGB444 is 1.5 bytes a pixel)
+        sent = self.display.pixel_bytes(sum(_area(r) for r in rects))
+        full_bytes = self.display.pixel_bytes(full_pixels)
+        self.frames += 1
+        self.bytes_sent += sent
+        self.bytes_full += full_bytes
+        self.last = {
+            'rects': len(rects),
+            'bytes': sent,
+            'saved': full_bytes - sent,
+        }
+        return self.last
+
+    def stats(self):
+        """Totals since creation: frames, bytes sent and bytes saved vs. full frames"""
+        return {
+            'frames': self.frames,
+            'bytes_sent': self.bytes_sent,
+            'bytes_saved': self.bytes_full - self.bytes_sent,
+        }
+
+def _area(rect):
+    return (rect[2] - rect[0]) * (rect[3] - rect[1])
+
+def _even(rect, height, width):
+    """rect grown by a column (or row) to an even pixel count, for RGB444's pixel pairs.
+
+    The extra pixels are outside every dirty rectangle's rows or columns,
+    so they are unchanged: the frame and the shadow agree there.
+    """
+    x0, y0, x1, y1 = rect
+    if _area(rect) % 2 == 0:
+        return rect
+    if x1 < width:
+        return (x0, y0, x1 + 1, y1)
+    if x0 > 0:
+        return (x0 - 1, y0, x1, y1)
+    if y1 < height:
+        return (x0, y0, x1, y1 + 1)
+    return (x0, y0 - 1, x1, y1)
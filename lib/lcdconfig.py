@@ -30,38 +30,289 @@
 import os
 import sys
 import time
-import spidev
 import logging
 import numpy as np
-from gpiozero import *
+from . import rgb565
+
+# The hardware libraries are only needed for a real panel; lib.virtual
+# stands in for both off the Pi
+try:
+    import spidev
+except ImportError:
+    spidev = None
+try:
+    from gpiozero import DigitalOutputDevice, DigitalInputDevice, PWMOutputDevice
+except ImportError:
+    DigitalOutputDevice = DigitalInputDevice = PWMOutputDevice = None
+try:
+    import lgpio
+except ImportError:
+    lgpio = None
+
+# MADCTL (0x36), the memory access control register of the ST7735/ST7789,
+# ILI9341 and GC9A01 controllers. MV swaps the window's columns and rows,
+# MX and MY mirror them, so together they turn the picture in quarter turns.
+MADCTL_MY = 0x80
+MADCTL_MX = 0x40
+MADCTL_MV = 0x20
+MADCTL_ML = 0x10
+MADCTL_ROTATION = MADCTL_MY | MADCTL_MX | MADCTL_MV
+ROTATIONS = (0, 90, 180, 270)
+
+# Pixel formats for COLMOD (0x3A): rgb444 sends two pixels in three bytes
+BITS_PER_PIXEL = {'rgb565': 16, 'rgb444': 12}
+
+SPIDEV_BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+SPIDEV_BUFSIZ_DEFAULT = 4096
+
+def spidev_bufsiz():
+    """Largest single transfer the spidev kernel driver accepts (bufsiz module parameter)"""
+    try:
+        with open(SPIDEV_BUFSIZ_PATH) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return SPIDEV_BUFSIZ_DEFAULT
+
+class GpiozeroBackend(object):
+    """Pins through gpiozero, which works with whatever pin factory is installed"""
+
+    def __init__(self):
+        if DigitalOutputDevice is None:
+            raise ImportError('gpiozero is not installed (sudo apt install python3-gpiozero)')
+
+    def output(self, pin, initial_value = False):
+        return DigitalOutputDevice(pin, active_high = True, initial_value = initial_value)
+
+    def input(self, pin, pull_up = None, active_state = True):
+        return DigitalInputDevice(pin, pull_up = pull_up, active_state = active_state)
+
+    def pwm(self, pin, frequency):
+        return PWMOutputDevice(pin, frequency = frequency)
+
+    def close(self):
+        pass
+
+class LgpioBackend(object):
+    """Pins through lgpio calls on an open gpiochip, without gpiozero in between.
+
+    gpiozero resolves every on()/off() through its device and pin-factory
+    layers; here a write is one lgpio call. chip is the gpiochip number
+    (0 on current Raspberry Pi OS, including the Pi 5).
+    """
+
+    def __init__(self, chip = 0):
+        if lgpio is None:
+            raise ImportError('lgpio is not installed (sudo apt install python3-lgpio)')
+        self.handle = lgpio.gpiochip_open(chip)
+
+    def output(self, pin, initial_value = False):
+        return LgpioOutput(self.handle, pin, initial_value)
+
+    def input(self, pin, pull_up = None, active_state = True):
+        return LgpioInput(self.handle, pin, pull_up, active_state)
+
+    def pwm(self, pin, frequency):
+        return LgpioPWM(self.handle, pin, frequency)
+
+    def close(self):
+        lgpio.gpiochip_close(self.handle)
+
+class LgpioOutput(object):
+    def __init__(self, handle, pin, initial_value = False):
+        self.handle = handle
+        self.pin = pin
+        self.value = int(bool(initial_value))
+        lgpio.gpio_claim_output(handle, pin, self.value)
+
+    def on(self):
+        lgpio.gpio_write(self.handle, self.pin, 1)
+        self.value = 1
+
+    def off(self):
+        lgpio.gpio_write(self.handle, self.pin, 0)
+        self.value = 0
+
+    def close(self):
+        lgpio.gpio_free(self.handle, self.pin)
+
+class LgpioInput(object):
+    def __init__(self, handle, pin, pull_up = None, active_state = True):
+        self.handle = handle
+        self.pin = pin
+        flags = {True: lgpio.SET_PULL_UP, False: lgpio.SET_PULL_DOWN}.get(pull_up, lgpio.SET_PULL_NONE)
+        self.active = 0 if pull_up else int(bool(active_state))
+        lgpio.gpio_claim_input(handle, pin, flags)
+
+    @property
+    def value(self):
+        return int(lgpio.gpio_read(self.handle, self.pin) == self.active)
+
+    def close(self):
+        lgpio.gpio_free(self.handle, self.pin)
+
+class LgpioPWM(object):
+    """Software PWM with gpiozero's value (0..1) / frequency interface"""
+
+    def __init__(self, handle, pin, frequency):
+        self.handle = handle
+        self.pin = pin
+        self._frequency = frequency
+        self._value = 0
+        lgpio.gpio_claim_output(handle, pin, 0)
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        lgpio.tx_pwm(self.handle, self.pin, self._frequency, value * 100)
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @frequency.setter
+    def frequency(self, frequency):
+        self._frequency = frequency
+        lgpio.tx_pwm(self.handle, self.pin, frequency, self._value * 100)
+
+    def close(self):
+        lgpio.tx_pwm(self.handle, self.pin, 0, 0)
+        lgpio.gpio_free(self.handle, self.pin)
+
+GPIO_BACKENDS = {'gpiozero': GpiozeroBackend, 'lgpio': LgpioBackend}
+
+def gpio_backend(name = 'auto'):
+    """A GPIO backend by name; 'auto' is lgpio when it is installed and usable, else gpiozero"""
+    if name != 'auto':
+        return GPIO_BACKENDS[name]()
+    if lgpio is not None:
+        try:
+            return LgpioBackend()
+        except lgpio.error:
+            if DigitalOutputDevice is None:
+                raise
+    return GpiozeroBackend()
+
+def madctl_to_memory(madctl, memory, column, row):
+    """Frame memory cell (column, row) that window address (column, row) writes under madctl.
+
+    memory is the controller's (columns, rows) with no MADCTL bits set.
+    """
+    columns, rows = memory
+    if madctl & MADCTL_MV:
+        column, row = row, column
+    if madctl & MADCTL_MX:
+        column = columns - 1 - column
+    if madctl & MADCTL_MY:
+        row = rows - 1 - row
+    return column, row
+
+def madctl_to_window(madctl, memory, column, row):
+    """Inverse of madctl_to_memory"""
+    columns, rows = memory
+    if madctl & MADCTL_MX:
+        column = columns - 1 - column
+    if madctl & MADCTL_MY:
+        row = rows - 1 - row
+    if madctl & MADCTL_MV:
+        column, row = row, column
+    return column, row
+
+def orientation(madctl, offset, memory, size, rotation):
+    """MADCTL value and window offset that turn the picture rotation degrees counter-clockwise.
+
+    madctl, offset and size describe the panel at rotation 0: what Init
+    writes to 0x36, the window address of pixel (0, 0) and (width, height).
+    Bits other than MY/MX/MV are kept.
+    """
+    if rotation not in ROTATIONS:
+        raise ValueError('Rotation must be one of {0}, not {1}'.format(ROTATIONS, rotation))
+    width, height = size
+    # Where pixel (x, y) of the turned picture sits in the rotation 0 picture
+    place = {
+        0: lambda x, y: (x, y),
+        90: lambda x, y: (y, height - 1 - x),
+        180: lambda x, y: (width - 1 - x, height - 1 - y),
+        270: lambda x, y: (width - 1 - y, x),
+    }[rotation]
+
+    def cell(x, y):
+        x, y = place(x, y)
+        return madctl_to_memory(madctl, memory, x + offset[0], y + offset[1])
+
+    for bits in range(0, 0x100, 0x20):
+        candidate = (madctl & ~MADCTL_ROTATION) | bits
+        x0, y0 = madctl_to_window(candidate, memory, *cell(0, 0))
+        if (madctl_to_window(candidate, memory, *cell(1, 0)) == (x0 + 1, y0) and
+                madctl_to_window(candidate, memory, *cell(0, 1)) == (x0, y0 + 1)):
+            return candidate, (x0, y0)
+    raise ValueError('No MADCTL value turns the panel by {0} degrees'.format(rotation))
 
 class RaspberryPi:
-    def __init__(self,spi=spidev.SpiDev(0,0),spi_freq=40000000,rst = 27,dc = 25,bl = 18,bl_freq=1000,i2c=None,i2c_freq=100000):
+    # Controller geometry, set by each driver: frame memory (columns, rows)
+    # with no MADCTL bits set, the MADCTL value Init writes, and the window
+    # address of the panel's top-left pixel at that MADCTL
+    MEMORY = (240, 320)
+    MADCTL = 0x00
+    OFFSET = (0, 0)
+    # MADCTL bits added for the 90 and 270 degree turns: ML (refresh the
+    # panel bottom to top) on the panels whose vendor code set it in
+    # landscape. It changes the scan order only, not where pixels go.
+    LANDSCAPE_MADCTL = 0x00
+    # COLMOD value for each pixel format the controller takes over SPI
+    COLMOD = {'rgb565': 0x05, 'rgb444': 0x03}
+    # Init sequence, see send_init()
+    INIT = ()
+
+    rotation = 0            # see set_rotation()
+    pixel_format = 'rgb565' # see set_pixel_format()
+
+    def __init__(self,spi=(0, 0),spi_freq=40000000,rst = 27,dc = 25,bl = 18,bl_freq=1000,i2c=None,i2c_freq=100000,gpio='auto'):
         self.np=np
+        # gpio is a backend name (see GPIO_BACKENDS) or a backend object
+        self.GPIO = gpio_backend(gpio) if isinstance(gpio, str) else gpio
+        self.rgb565 = rgb565.RGB565()
+        self.rgb444 = rgb565.RGB444()
         self.INPUT = False
         self.OUTPUT = True
 
         self.SPEED  =spi_freq
         self.BL_freq=bl_freq
+        self.window_offset = self.OFFSET
 
         self.RST_PIN= self.gpio_mode(rst,self.OUTPUT)
         self.DC_PIN = self.gpio_mode(dc,self.OUTPUT)
+        # Level DC was last set to: command() and data() runs skip rewriting it
+        self.DC_level = None
         self.BL_PIN = self.gpio_pwm(bl)
         self.bl_DutyCycle(0)
         
-        #Initialize SPI
+        #Initialize SPI: spi is an open device, a (bus, device) pair to open, or None for no output
+        if isinstance(spi, tuple):
+            if spidev is None:
+                raise ImportError('spidev is not installed (sudo apt install python3-spidev)')
+            spi = spidev.SpiDev(*spi)
         self.SPI = spi
+        self.SPI_BUFSIZ = spidev_bufsiz()
         if self.SPI!=None :
             self.SPI.max_speed_hz = spi_freq
             self.SPI.mode = 0b00
 
     def gpio_mode(self,Pin,Mode,pull_up = None,active_state = True):
         if Mode:
-            return DigitalOutputDevice(Pin,active_high = True,initial_value =False)
+            return self.GPIO.output(Pin,initial_value = False)
         else:
-            return DigitalInputDevice(Pin,pull_up=pull_up,active_state=active_state)
+            return self.GPIO.input(Pin,pull_up=pull_up,active_state=active_state)
 
     def digital_write(self, Pin, value):
+        if Pin is self.DC_PIN:
+            value = bool(value)
+            if value == self.DC_level:
+                return
+            self.DC_level = value
         if value:
             Pin.on()
         else:
@@ -74,12 +325,164 @@ class RaspberryPi:
         time.sleep(delaytime / 1000.0)
 
     def gpio_pwm(self,Pin):
-        return PWMOutputDevice(Pin,frequency = self.BL_freq)
+        return self.GPIO.pwm(Pin,self.BL_freq)
 
     def spi_writebyte(self, data):
         if self.SPI!=None :
             self.SPI.writebytes(data)
 
+    def spi_writebuf(self, data):
+        """Write a whole buffer (bytes, bytearray, memoryview or numpy array).
+
+        The buffer is handed to spidev without building a Python list.
+        writebytes2 splits it into bufsiz-sized transfers itself; older
+        spidev releases without it get the same chunking done here.
+        """
+        if self.SPI==None :
+            return
+        if isinstance(data, self.np.ndarray):
+            data = self.np.ascontiguousarray(data)
+        buf = memoryview(data).cast('B')
+        if hasattr(self.SPI, 'writebytes2'):
+            self.SPI.writebytes2(buf)
+        else:
+            for i in range(0, len(buf), self.SPI_BUFSIZ):
+                self.SPI.writebytes(buf[i:i+self.SPI_BUFSIZ].tolist())
+
+    def Init(self, pixel_format = 'rgb565'):
+        """Initialize dispaly"""
+        self.module_init()
+        self.reset()
+        self.send_init(self.INIT, pixel_format)
+
+    def send_init(self, table, pixel_format = 'rgb565'):
+        """Run an init sequence of (command, parameters, delay ms) rows.
+
+        Rows for MADCTL (0x36) and COLMOD (0x3A) with parameters None are
+        programmed at that point by set_rotation() and set_pixel_format().
+        """
+        for cmd, params, delay in table:
+            if params is None and cmd == 0x36:
+                self.set_rotation(self.rotation)
+            elif params is None and cmd == 0x3A:
+                self.set_pixel_format(pixel_format)
+            else:
+                self.write_register(cmd, params)
+            if delay:
+                self.delay_ms(delay)
+
+    def write_register(self, cmd, params = ()):
+        """Send a command followed by all of its parameter bytes in a single SPI transfer"""
+        self.command(cmd)
+        if params:
+            self.digital_write(self.DC_PIN,True)
+            self.spi_writebyte(list(params))
+
+    def set_rotation(self, rotation):
+        """Turn the picture 0, 90, 180 or 270 degrees counter-clockwise (like PIL's rotate).
+
+        The controller does the turning through MADCTL, so images are sent
+        unrotated at panel_size() and cost nothing extra per frame.
+        """
+        madctl, offset = orientation(self.MADCTL, self.OFFSET, self.MEMORY,
+                                     (self.width, self.height), rotation)
+        if rotation in (90, 270):
+            madctl |= self.LANDSCAPE_MADCTL
+        self.write_register(0x36, (madctl,))
+        self.rotation = rotation
+        self.window_offset = offset
+
+    def set_pixel_format(self, pixel_format):
+        """Program COLMOD for 'rgb565' or 'rgb444' (12 bits per pixel, a quarter fewer SPI bytes).
+
+        Called from Init(pixel_format); frames are converted by ShowRegion()
+        whatever format they come in.
+        """
+        if pixel_format not in self.COLMOD:
+            raise ValueError('{0} does not support {1}; use one of {2}'.format(
+                type(self).__name__, pixel_format, sorted(self.COLMOD)))
+        self.write_register(0x3A, (self.COLMOD[pixel_format],))
+        self.pixel_format = pixel_format
+
+    def pixel_bytes(self, pixels):
+        """SPI bytes for that many pixels in the current pixel format"""
+        return (pixels * BITS_PER_PIXEL[self.pixel_format] + 7) // 8
+
+    def panel_size(self):
+        """(width, height) of the display in its current orientation"""
+        if self.rotation % 180:
+            return self.height, self.width
+        return self.width, self.height
+
+    def SetWindows(self, Xstart, Ystart, Xend, Yend):
+        """Address the rectangle [Xstart, Xend) x [Ystart, Yend) and start a memory write"""
+        x, y = self.window_offset
+        Xend, Yend = Xend - 1 + x, Yend - 1 + y
+        Xstart, Ystart = Xstart + x, Ystart + y
+        self.write_register(0x2A, (Xstart>>8 & 0xff, Xstart & 0xff, Xend>>8 & 0xff, Xend & 0xff))
+        self.write_register(0x2B, (Ystart>>8 & 0xff, Ystart & 0xff, Yend>>8 & 0xff, Yend & 0xff))
+        self.command(0x2C)
+
+    def ShowImage(self, Image, Xstart = 0, Ystart = 0):
+        """Write a whole frame: a PIL image, an HxWx3 RGB array or a packed HxWx2 array.
+
+        A frame with width and height swapped turns the panel a quarter
+        turn first (portrait <-> landscape). Xstart and Ystart are ignored,
+        as they always were on LCD_2inch and LCD_2inch4; use ShowRegion()
+        to write part of the panel.
+        """
+        pix = self.np.asarray(Image)
+        imheight, imwidth = pix.shape[:2]
+        self.match_orientation(imwidth, imheight)
+        width, height = self.panel_size()
+        if (imwidth, imheight) != (width, height):
+            raise ValueError('Image must be same dimensions as display ({0}x{1}).'.format(width, height))
+        self.ShowRegion(pix, 0, 0)
+
+    def match_orientation(self, width, height):
+        """Turn the panel a quarter turn if width x height is its size swapped; returns whether it turned"""
+        panel_width, panel_height = self.panel_size()
+        if (width, height) != (panel_height, panel_width) or width == height:
+            return False
+        self.set_rotation({0: 270, 270: 0, 90: 180, 180: 90}[self.rotation])
+        return True
+
+    def clear(self):
+        """Clear contents of image buffer"""
+        width, height = self.panel_size()
+        _buffer = b'\xff' * self.pixel_bytes(width * height)
+        self.SetWindows(0, 0, width, height)
+        self.digital_write(self.DC_PIN,True)
+        self.spi_writebuf(_buffer)
+
+    def ShowRegion(self, Image, Xstart, Ystart):
+        """Write only a rectangle of the display, top-left corner at (Xstart, Ystart).
+
+        Image may be a PIL image, an HxWx3 RGB array or an HxWx2 array that
+        is already packed RGB565. Panel offsets are applied by SetWindows.
+        """
+        pix = self.np.asarray(Image)
+        imheight, imwidth = pix.shape[:2]
+        if imwidth == 0 or imheight == 0:
+            return
+        width, height = self.panel_size()
+        if Xstart < 0 or Ystart < 0 or Xstart + imwidth > width or Ystart + imheight > height:
+            raise ValueError('Region {0}x{1} at ({2},{3}) is outside the display ({4}x{5}).'
+                .format(imwidth, imheight, Xstart, Ystart, width, height))
+        if self.pixel_format == 'rgb444':
+            if imwidth * imheight % 2:
+                # Pixels go out in pairs. A write past the end of the window
+                # wraps to its start, so repeating the first pixel completes
+                # the last pair without changing anything on the glass
+                flat = pix.reshape(1, -1, pix.shape[2])
+                pix = self.np.concatenate((flat, flat[:, :1]), axis = 1)
+            pix = self.rgb444.pack(pix)
+        elif pix.ndim != 3 or pix.shape[2] != 2:
+            pix = self.rgb565.pack(pix)
+        self.SetWindows(Xstart, Ystart, Xstart + imwidth, Ystart + imheight)
+        self.digital_write(self.DC_PIN,True)
+        self.spi_writebuf(pix)
+
     def bl_DutyCycle(self, duty):
         self.BL_PIN.value = duty / 100
         
@@ -101,6 +504,7 @@ class RaspberryPi:
         self.digital_write(self.RST_PIN, 1)
         self.digital_write(self.DC_PIN, 0)   
         self.BL_PIN.close()
+        self.GPIO.close()
         time.sleep(0.001)
 
 
@@ -0,0 +1,543 @@
+#!/usr/bin/python3
+# Threaded frame pipelines.
+#
+# ReceivePipeline (screen_stream.py):
+#
+#   reader   socket -> frames queue (bounded)
+#   decoder  frames queue -> display slot (holds one frame)
+#   display  display slot -> SPI
+#
+# Each stage runs in its own thread so a slow SPI write never stalls the
+# socket and the sender's TCP window stays open. When a stage falls behind,
+# frames are dropped rather than queued:
+#   - the display always shows the newest decoded frame; older ones that
+#     were never shown are counted as display drops
+#   - the reader throws away queued frames when the decoder is behind.
+#     Tile deltas only make sense on top of the frame before them, so
+#     after such a drop every delta is discarded until the next keyframe.
+#
+# SendPipeline (screen_capture.py): capture on a deadline-based Pacer,
+# encode and send in their own threads, freshest capture wins.
+
+import collections
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+from . import protocol
+
+# What a corrupt or truncated payload makes the decoders raise: zlib and
+# struct errors, OSError from PIL (UnidentifiedImageError, truncated
+# images), RuntimeError from lz4.frame, ValueError for everything else
+DECODE_ERRORS = (ValueError, zlib.error, struct.error, OSError, RuntimeError)
+
+class LatestSlot(object):
+    """A one-item mailbox: put() replaces whatever has not been taken yet.
+
+    The taker counts as idle until its first get() and whenever get() has
+    found the slot empty, and the next item is its own: a put() before it
+    has been taken waits for that rather than replace it. Only items that
+    arrive while the taker is busy with an earlier one are replaced.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.idle = True
+        self.closed = False
+
+    def put(self, item):
+        """Store item; returns True if an unread item was overwritten"""
+        with self.cond:
+            if self.idle:
+                self.cond.wait_for(lambda: self.item is None or self.closed)
+            replaced = self.item is not None
+            self.item = item
+            self.cond.notify_all()
+            return replaced
+
+    def get(self, timeout = None):
+        """Wait for an item; returns None once closed or after timeout"""
+        with self.cond:
+            if self.item is None and not self.closed:
+                self.idle = True
+                self.cond.wait(timeout)
+            item, self.item = self.item, None
+            self.idle = item is None
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class ReceivePipeline(object):
+    """Runs one connection through the reader, decoder and display threads.
+
+    decoder is a codec.FrameDecoder; show(kind, frame) is called from the
+    display thread with whatever decode() returned. run() blocks until the
+    client disconnects or a stage fails.
+
+    Every frame is acknowledged once it has been shown or dropped (see
+    protocol.send_ack) so the sender can limit how many frames are in
+    flight; a dropped delta also asks the sender for a keyframe.
+
+    Other control frames from the sender are passed to on_control(payload)
+    on the display thread, before the next frame is shown.
+    """
+
+    def __init__(self, conn, decoder, show, queue_size = 2, on_control = None):
+        self.conn = conn
+        self.decoder = decoder
+        self.show = show
+        self.on_control = on_control
+        self.controls = collections.deque()
+        self.frames = queue.Queue(queue_size)
+        # Payloads are views into reused buffers, each held until the decoder
+        # is done with it or the frame is dropped
+        self.reader = protocol.FrameReader(conn, hold = True)
+        self.slot = LatestSlot()
+        self.stop = threading.Event()
+        self.send_lock = threading.Lock()
+        self.error = None
+        self.need_keyframe = False
+        self.counters = {
+            'received': 0,
+            'decoded': 0,
+            'displayed': 0,
+            'reader_drops': 0,      # frames discarded because the decoder was behind
+            'decode_drops': 0,      # frames that failed to decode
+            'display_drops': 0,     # decoded frames replaced before they were shown
+        }
+
+    def run(self):
+        threads = [
+            threading.Thread(target = self._stage, args = (self._read,), name = 'reader'),
+            threading.Thread(target = self._stage, args = (self._decode,), name = 'decoder'),
+            threading.Thread(target = self._stage, args = (self._display,), name = 'display'),
+        ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return self.counters
+
+    def _stage(self, loop):
+        try:
+            loop()
+        except Exception as e:
+            # Errors after another stage stopped the pipeline are just fallout
+            if self.error is None and not self.stop.is_set():
+                self.error = e
+        finally:
+            self._close()
+
+    def _close(self):
+        if self.stop.is_set():
+            return
+        self.stop.set()
+        self.slot.close()
+        try:
+            # Wakes the reader if it is blocked in recv()
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            pass        # the decoder checks self.stop between frames
+
+    def _ack(self, seq, displayed = False, decode_time = 0.0, display_time = 0.0):
+        with self.send_lock:
+            protocol.send_ack(self.conn, seq, displayed, decode_time, display_time)
+
+    def _request_keyframe(self):
+        with self.send_lock:
+            protocol.send_control(self.conn, protocol.CONTROL_REQUEST_KEYFRAME)
+
+    def _lose_canvas(self):
+        """Deltas cannot be applied until the next keyframe; ask for one"""
+        if not self.need_keyframe:
+            self.need_keyframe = True
+            self._request_keyframe()
+
+    def _drop_delta(self, header, payload):
+        self.reader.release(payload)
+        self._lose_canvas()
+        self.counters['reader_drops'] += 1
+        self._ack(header.seq)
+
+    def _read(self):
+        while not self.stop.is_set():
+            header, payload = self.reader.read()
+            if header is None:
+                return
+            if header.type == protocol.FRAME_CONTROL:
+                if payload and self.on_control is not None:
+                    self.controls.append(bytes(payload))
+                self.reader.release(payload)
+                continue
+            if header.type == protocol.FRAME_HEARTBEAT:
+                self.reader.release(payload)
+                continue
+            self.counters['received'] += 1
+
+            if header.type == protocol.FRAME_KEYFRAME:
+                self.need_keyframe = False
+            elif self.need_keyframe:
+                self._drop_delta(header, payload)
+                continue
+
+            try:
+                self.frames.put_nowait((header, payload))
+            except queue.Full:
+                # Acks are cumulative, so the frame acked next covers the queued ones
+                self._drop_queued()
+                if header.type == protocol.FRAME_KEYFRAME:
+                    self.frames.put_nowait((header, payload))
+                else:
+                    self._drop_delta(header, payload)
+
+    def _drop_queued(self):
+        while True:
+            try:
+                item = self.frames.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self.reader.release(item[1])
+            self.counters['reader_drops'] += 1
+
+    def _decode(self):
+        while not self.stop.is_set():
+            try:
+                item = self.frames.get(timeout = 0.5)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            header, payload = item
+            if header.type == protocol.FRAME_DELTA and self.need_keyframe:
+                # Queued behind a frame that failed to decode
+                self.reader.release(payload)
+                self.counters['decode_drops'] += 1
+                self._ack(header.seq)
+                continue
+            start = time.perf_counter()
+            try:
+                decoded = self.decoder.decode(header, payload)
+            except DECODE_ERRORS:
+                # A bad keyframe leaves nothing to apply deltas to, a bad
+                # delta (possibly half applied) a wrong canvas
+                self.counters['decode_drops'] += 1
+                self._lose_canvas()
+                self._ack(header.seq)
+                continue
+            finally:
+                # Nothing keeps a reference to the payload once decoded
+                self.reader.release(payload)
+            if decoded is None:
+                self._ack(header.seq)
+                continue
+            self.counters['decoded'] += 1
+            if self.slot.put((header.seq, time.perf_counter() - start, decoded)):
+                self.counters['display_drops'] += 1
+
+    def _display(self):
+        item = None
+        while not self.stop.is_set():
+            if item is None:
+                item = self.slot.get(0.5)
+                if item is None:
+                    continue
+            seq, decode_time, decoded = item
+            while self.controls:
+                self.on_control(self.controls.popleft())
+            start = time.perf_counter()
+            self.show(*decoded)
+            self.counters['displayed'] += 1
+            display_time = time.perf_counter() - start
+            # Take the next frame before acking this one: the ack may let the
+            # sender send another, which must not replace it in the slot
+            item = self.slot.get(0)
+            self._ack(seq, True, decode_time, display_time)
+
+def format_counters(counters):
+    """One line summary of ReceivePipeline.counters"""
+    return ('{received} received, {decoded} decoded, {displayed} displayed; '
+            'dropped {reader_drops} in reader, {decode_drops} in decoder, '
+            '{display_drops} before display'.format(**counters))
+
+class Pacer(object):
+    """Deadline-based frame timer.
+
+    wait() sleeps until the next deadline instead of for a fixed delay, so
+    the time spent on a frame comes out of the frame period rather than
+    being added to it. If a frame overruns by more than a whole period the
+    schedule restarts from now instead of firing a burst of late frames.
+    slowdown stretches the period while the screen is idle.
+    """
+
+    def __init__(self, rate, stop = None):
+        self.rate = float(rate)
+        self.slowdown = 1.0
+        self.stop = stop if stop is not None else threading.Event()
+        self.deadline = time.perf_counter()
+
+    def period(self):
+        return self.slowdown / self.rate
+
+    def restart(self):
+        """Back to full rate, with the next deadline one normal period from now"""
+        self.slowdown = 1.0
+        self.deadline = time.perf_counter() + self.period()
+
+    def wait(self):
+        """Sleep until the next deadline; returns False if stop was set meanwhile"""
+        period = self.period()
+        now = time.perf_counter()
+        if now - self.deadline > period:
+            self.deadline = now
+        if self.deadline > now and self.stop.wait(self.deadline - now):
+            return False
+        self.deadline += period
+        return not self.stop.is_set()
+
+class SendPipeline(object):
+    """Sender side: capture, encode and send as separate stages.
+
+    grab() returns (frame, order) for the current screen contents and runs
+    on the thread that calls run(), paced at framerate. Captured frames go
+    through a LatestSlot, so when encoding or the network falls behind the
+    encoder always picks up the freshest capture and older ones are
+    dropped. Encoded frames are handed to the send thread one at a time;
+    the encoder needs every frame it produced to be sent, since a delta
+    refers to the frame before it. on_sent(encoded) is called after each
+    frame is sent.
+
+    At most max_in_flight frames are encoded but not yet acknowledged by
+    the Pi; while the limit is reached captures are skipped rather than
+    queued, so frames never pile up in socket buffers. If no ack arrives
+    for ack_timeout seconds (a receiver that does not ack) the limit is
+    ignored until one does. None disables the limit.
+
+    controller, if given, has update(pipeline) called once per frame
+    period from the capture loop (see control.AdaptiveController).
+
+    If prepare is given, grab() returns a raw capture and prepare(capture)
+    turns it into (frame, order). fingerprint(capture), if given, returns a
+    cheap checksum of the raw capture: captures matching the last one are
+    not prepared, encoded or sent (the send thread's heartbeats keep the
+    connection up), and once nothing has changed for idle_after seconds the
+    capture rate ramps down towards idle_rate. The first change goes back
+    to the full rate at once.
+    """
+
+    def __init__(self, sock, grab, encoder, framerate, keyframe_interval = 5.0,
+                 on_sent = None, heartbeat_interval = 1.0, max_in_flight = 2, ack_timeout = 1.0,
+                 controller = None, prepare = None, fingerprint = None, idle_rate = 2.0, idle_after = 1.0):
+        self.sock = sock
+        self.grab = grab
+        self.prepare = prepare
+        self.fingerprint = fingerprint
+        self.idle_rate = idle_rate
+        self.idle_after = idle_after
+        self.last_fingerprint = None
+        self.last_change = time.perf_counter()
+        self.encoder = encoder
+        self.keyframe_interval = keyframe_interval
+        self.on_sent = on_sent
+        self.heartbeat_interval = heartbeat_interval
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.controller = controller
+        self.stop = threading.Event()
+        self.pacer = Pacer(framerate, self.stop)
+        self.slot = LatestSlot()
+        self.outgoing = queue.Queue(1)
+        self.error = None
+        self.seq = 0                    # next sequence number to encode
+        self.acked = 0                  # every seq below this has been acked
+        self.last_ack_time = time.perf_counter()
+        self.keyframe_requested = False
+        self.capture_times = {}         # seq -> capture time.time(), until acked
+        self.latency = None             # capture-to-displayed seconds, moving average
+        self.pi_time = None             # Pi decode + display seconds per frame, moving average
+        self.counters = {
+            'captured': 0,
+            'encoded': 0,
+            'sent': 0,
+            'heartbeats': 0,
+            'acked': 0,
+            'displayed': 0,
+            'capture_drops': 0,     # captures replaced before the encoder took them
+            'in_flight_skips': 0,   # captures skipped because max_in_flight was reached
+            'unchanged': 0,         # captures identical to the previous one, not sent
+            'keyframe_requests': 0,
+        }
+
+    def run(self):
+        threads = [
+            threading.Thread(target = self._stage, args = (self._encode,), name = 'encoder'),
+            threading.Thread(target = self._stage, args = (self._send,), name = 'sender'),
+            threading.Thread(target = self._stage, args = (self._receive,), name = 'acks'),
+        ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            self._stage(self._capture)
+        except KeyboardInterrupt:
+            self.close()
+            raise
+        finally:
+            for t in threads:
+                t.join()
+        return self.counters
+
+    def _stage(self, loop):
+        try:
+            loop()
+        except Exception as e:
+            # Errors after another stage stopped the pipeline are just fallout
+            if self.error is None and not self.stop.is_set():
+                self.error = e
+        finally:
+            self.close()
+
+    def close(self):
+        if self.stop.is_set():
+            return
+        self.stop.set()
+        self.slot.close()
+        try:
+            # Wakes the ack reader if it is blocked in recv()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def in_flight(self):
+        """Frames encoded but not acknowledged yet"""
+        return self.seq - self.acked
+
+    def _may_capture(self):
+        if self.max_in_flight is None or self.in_flight() < self.max_in_flight:
+            return True
+        return time.perf_counter() - self.last_ack_time > self.ack_timeout
+
+    def _capture(self):
+        while self.pacer.wait():
+            if self.controller is not None:
+                self.controller.update(self)
+            if not self._may_capture():
+                self.counters['in_flight_skips'] += 1
+                continue
+            capture_time = time.time()
+            capture = self.grab()
+            self.counters['captured'] += 1
+            if self._unchanged(capture):
+                self.counters['unchanged'] += 1
+                continue
+            if self.prepare is not None:
+                frame, order = self.prepare(capture)
+            else:
+                frame, order = capture
+            if self.slot.put((frame, order, capture_time)):
+                self.counters['capture_drops'] += 1
+
+    def _unchanged(self, capture):
+        if self.fingerprint is None:
+            return False
+        fingerprint = self.fingerprint(capture)
+        now = time.perf_counter()
+        if fingerprint != self.last_fingerprint or self.keyframe_requested:
+            self.last_fingerprint = fingerprint
+            self.last_change = now
+            if self.pacer.slowdown != 1.0:
+                self.pacer.restart()
+            return False
+        if now - self.last_change > self.idle_after:
+            # Idle: stretch the capture period a little more each time
+            limit = max(1.0, self.pacer.rate / self.idle_rate)
+            self.pacer.slowdown = min(limit, self.pacer.slowdown * 1.25)
+        return True
+
+    def _encode(self):
+        last_keyframe_time = 0
+        while not self.stop.is_set():
+            item = self.slot.get(0.5)
+            if item is None:
+                continue
+            frame, order, capture_time = item
+            keyframe = self.keyframe_requested or capture_time - last_keyframe_time >= self.keyframe_interval
+            self.keyframe_requested = False
+            encoded = self.encoder.encode(frame, keyframe, order)
+            if encoded.frame_type == protocol.FRAME_KEYFRAME:
+                last_keyframe_time = capture_time
+            self.counters['encoded'] += 1
+            height, width = frame.shape[:2]
+            item = (encoded, width, height, self.seq, capture_time)
+            self.capture_times[self.seq] = capture_time
+            self.seq += 1
+            while not self.stop.is_set():
+                try:
+                    self.outgoing.put(item, timeout = 0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def _send(self):
+        while not self.stop.is_set():
+            try:
+                encoded, width, height, seq, capture_time = self.outgoing.get(timeout = self.heartbeat_interval)
+            except queue.Empty:
+                # Nothing to send for a while: keep the connection alive
+                protocol.send_heartbeat(self.sock, self.seq)
+                self.counters['heartbeats'] += 1
+                continue
+            start = time.perf_counter()
+            protocol.send_frame(self.sock, encoded.frame_type, encoded.payload, encoded.codec,
+                                width, height, seq, capture_time)
+            self.encoder.record_send(len(encoded.payload), time.perf_counter() - start)
+            self.counters['sent'] += 1
+            if self.on_sent is not None:
+                self.on_sent(encoded)
+
+    def _receive(self):
+        reader = protocol.FrameReader(self.sock)
+        while not self.stop.is_set():
+            header, payload = reader.read()
+            if header is None:
+                return
+            if header.type != protocol.FRAME_CONTROL or not payload:
+                continue
+            if payload[0] == protocol.CONTROL_REQUEST_KEYFRAME:
+                self.keyframe_requested = True
+                self.counters['keyframe_requests'] += 1
+            elif payload[0] == protocol.CONTROL_ACK:
+                self.on_ack(*protocol.parse_ack(payload))
+
+    def on_ack(self, seq, displayed, decode_time, display_time):
+        """Handle an ack from the Pi; seq is the 32-bit wire value"""
+        newest = self.seq - 1
+        seq = newest - ((newest - seq) & 0xFFFFFFFF)
+        if seq < self.acked:
+            return      # older than an ack already received
+        capture_time = None
+        for s in range(self.acked, seq + 1):
+            capture_time = self.capture_times.pop(s, None)
+        self.acked = seq + 1
+        self.last_ack_time = time.perf_counter()
+        self.counters['acked'] += 1
+        if displayed:
+            self.counters['displayed'] += 1
+            if capture_time is not None:
+                self.latency = _ema(self.latency, time.time() - capture_time)
+            self.pi_time = _ema(self.pi_time, decode_time + display_time)
+
+def _ema(average, value, weight = 0.3):
+    return value if average is None else average + (value - average) * weight
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# Wire protocol between screen_capture.py (Mac) and screen_stream.py (Pi).
+#
+# Every frame is a fixed header followed by `length` payload bytes:
+#
+#   magic      2s  b'MP'
+#   version    B   VERSION
+#   type       B   FRAME_*
+#   codec      B   CODEC_*
+#   width      H   frame size in pixels (0 for heartbeat/control)
+#   height     H
+#   seq        I   sequence number, wraps at 2**32
+#   timestamp  d   capture time, time.time() on the sender
+#   length     I   payload bytes
+#
+# All fields are big-endian.
+#
+# The Pi answers on the same socket with FRAME_CONTROL frames: an ACK for
+# each frame it is done with (cumulative: acking seq N covers every frame
+# up to N), and REQUEST_KEYFRAME when it had to drop a delta. The sender
+# may send SET_ROTATION first, to have the panel turn the picture itself.
+
+import struct
+import threading
+import time
+from collections import namedtuple
+
+MAGIC = b'MP'
+VERSION = 1
+
+FRAME_HEARTBEAT = 0
+FRAME_KEYFRAME = 1
+FRAME_DELTA = 2
+FRAME_CONTROL = 3
+
+CODEC_NONE = 0
+CODEC_JPEG_ZLIB = 1         # zlib-wrapped JPEG (old senders; still accepted)
+CODEC_TILES_ZLIB = 2        # zlib-wrapped lib.tiles payload
+CODEC_RGB565_ZLIB = 3       # panel-native big-endian RGB565, zlib level 1
+CODEC_RGB565_LZ4 = 4        # panel-native big-endian RGB565, lz4 frame
+CODEC_JPEG = 5
+CODEC_PNG = 6
+
+# First payload byte of a FRAME_CONTROL frame
+CONTROL_REQUEST_KEYFRAME = 1
+CONTROL_ACK = 2
+CONTROL_SET_ROTATION = 3
+
+# CONTROL_ACK body: seq, flags, decode seconds, display seconds
+ACK = struct.Struct('>IBff')
+ACK_DISPLAYED = 1           # the frame was shown (otherwise dropped or empty)
+
+# CONTROL_SET_ROTATION body: degrees counter-clockwise, 0/90/180/270
+ROTATION = struct.Struct('>H')
+
+HEADER = struct.Struct('>2sBBBHHIdI')
+
+FrameHeader = namedtuple('FrameHeader', 'magic version type codec width height seq timestamp length')
+
+class ProtocolError(Exception):
+    """The peer sent something that is not a valid frame"""
+
+def pack_header(frame_type, codec, width, height, seq, timestamp, length):
+    return HEADER.pack(MAGIC, VERSION, frame_type, codec, width, height,
+                       seq & 0xFFFFFFFF, timestamp, length)
+
+def send_frame(sock, frame_type, payload = b'', codec = CODEC_NONE, width = 0, height = 0,
+               seq = 0, timestamp = None):
+    """Send header and payload together; one sendmsg() call unless the socket buffer is full"""
+    if timestamp is None:
+        timestamp = time.time()
+    header = pack_header(frame_type, codec, width, height, seq, timestamp, len(payload))
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header + payload)
+        return
+    parts = [memoryview(header), memoryview(payload)]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if parts and sent:
+            parts[0] = parts[0][sent:]
+
+def send_heartbeat(sock, seq = 0):
+    send_frame(sock, FRAME_HEARTBEAT, seq = seq)
+
+def send_control(sock, code, body = b'', seq = 0):
+    send_frame(sock, FRAME_CONTROL, bytes((code,)) + body, seq = seq)
+
+def send_ack(sock, seq, displayed = True, decode_time = 0.0, display_time = 0.0):
+    flags = ACK_DISPLAYED if displayed else 0
+    send_control(sock, CONTROL_ACK, ACK.pack(seq & 0xFFFFFFFF, flags, decode_time, display_time))
+
+def parse_ack(payload):
+    """Body of a CONTROL_ACK frame as (seq, displayed, decode seconds, display seconds)"""
+    seq, flags, decode_time, display_time = ACK.unpack_from(payload, 1)
+    return seq, bool(flags & ACK_DISPLAYED), decode_time, display_time
+
+def send_rotation(sock, rotation):
+    send_control(sock, CONTROL_SET_ROTATION, ROTATION.pack(rotation))
+
+def parse_rotation(payload):
+    """Body of a CONTROL_SET_ROTATION frame in degrees"""
+    return ROTATION.unpack_from(payload, 1)[0]
+
+def recv_exact(sock, size):
+    """Read exactly size bytes into a new bytearray; None if the peer closed the connection first"""
+    data = bytearray(size)
+    if not recv_into_exact(sock, memoryview(data)):
+        return None
+    return data
+
+def recv_into_exact(sock, view):
+    """Fill view from sock; False if the peer closed the connection first"""
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            return False
+        view = view[n:]
+    return True
+
+def parse_header(data):
+    """FrameHeader from the first HEADER.size bytes of data"""
+    header = FrameHeader._make(HEADER.unpack_from(data))
+    if header.magic != MAGIC:
+        raise ProtocolError('Bad magic {0!r}'.format(header.magic))
+    if header.version != VERSION:
+        raise ProtocolError('Unsupported protocol version {0}'.format(header.version))
+    return header
+
+def recv_frame(sock):
+    """Read one frame; returns (FrameHeader, payload) or (None, None) on disconnect"""
+    data = recv_exact(sock, HEADER.size)
+    if data is None:
+        return None, None
+    header = parse_header(data)
+    payload = recv_exact(sock, header.length) if header.length else b''
+    if payload is None:
+        return None, None
+    return header, payload
+
+class FrameReader(object):
+    """Reads frames with recv_into() into reused buffers.
+
+    Payloads come back as memoryviews into bytearrays kept on a free list
+    and grown to the largest frame seen, so a steady stream allocates
+    nothing. By default a payload stays valid until the next read(). With
+    hold = True a payload keeps its buffer until release(payload) hands it
+    back, whatever order that happens in; for readers that pass payloads to
+    another thread. More buffers are allocated while all are held.
+    """
+
+    def __init__(self, sock, hold = False):
+        self.sock = sock
+        self.hold = hold
+        self.header = bytearray(HEADER.size)
+        self.free = [bytearray(0)]
+        self.lock = threading.Lock()
+        self.last = None
+
+    def read(self):
+        """Like recv_frame(): (FrameHeader, payload view) or (None, None) on disconnect"""
+        if self.last is not None:
+            self.release(self.last)
+            self.last = None
+        if not recv_into_exact(self.sock, memoryview(self.header)):
+            return None, None
+        header = parse_header(self.header)
+        if not header.length:
+            return header, b''
+        with self.lock:
+            buf = self.free.pop() if self.free else bytearray(header.length)
+        if len(buf) < header.length:
+            buf = bytearray(header.length)
+        payload = memoryview(buf)[:header.length]
+        if not self.hold:
+            self.last = payload
+        if not recv_into_exact(self.sock, payload):
+            return None, None
+        return header, payload
+
+    def release(self, payload):
+        """Give the buffer behind a held payload back for reuse; the payload must not be used after"""
+        if isinstance(payload, memoryview):
+            with self.lock:
+                self.free.append(payload.obj)
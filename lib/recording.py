@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+# Stream recordings: the exact bytes screen_capture.py sent, with the time
+# each frame went out, for replaying later (see lib.replay and
+# lib.benchmark --recording).
+#
+# File layout (big-endian):
+#
+#   header   MAGIC, VERSION, start time (time.time() when recording began)
+#   frames   protocol frames back to back, byte for byte as sent:
+#            keyframes, deltas, heartbeats and control frames
+#   index    one INDEX entry per frame: file offset, length (header and
+#            payload), seconds after the start when its first byte was sent
+#   trailer  index offset, frame count, INDEX_MAGIC
+#
+# The index is written when the recording is closed. A recording cut short
+# (killed sender, full disk) has no trailer; Recording then rebuilds the
+# index from the frame headers, timed by their capture timestamps, and
+# ignores a partly written last frame.
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from . import protocol
+
+MAGIC = b'MPRECORD'
+VERSION = 1
+HEADER = struct.Struct('>8sBd')
+INDEX = struct.Struct('>QId')
+INDEX_DTYPE = np.dtype([('offset', '>u8'), ('length', '>u4'), ('time', '>f8')])
+INDEX_MAGIC = b'MPINDEX\x00'
+TRAILER = struct.Struct('>QI8s')
+
+class RecordingError(Exception):
+    """The file is not a stream recording"""
+
+class Recorder(object):
+    """Appends the bytes sent on a connection to a recording file.
+
+    write() takes the stream in any pieces (as the socket accepted it);
+    frame boundaries are found from the protocol headers, so whatever
+    calls it needs no idea of frames. close() writes the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.start))
+        self.offset = HEADER.size
+        self.index = []
+        self.header = bytearray()   # protocol header of the frame being written, until complete
+        self.remaining = 0          # bytes still to come of the current frame
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        with self.lock:
+            self.file.write(data)
+            while data:
+                if self.remaining:
+                    n = min(self.remaining, len(data))
+                    self.remaining -= n
+                    self.offset += n
+                    data = data[n:]
+                    continue
+                if not self.header:
+                    self.index.append([self.offset, protocol.HEADER.size, time.perf_counter() - self.clock])
+                n = min(protocol.HEADER.size - len(self.header), len(data))
+                self.header += data[:n]
+                self.offset += n
+                data = data[n:]
+                if len(self.header) == protocol.HEADER.size:
+                    self.remaining = protocol.parse_header(self.header).length
+                    self.index[-1][1] += self.remaining
+                    self.header = bytearray()
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            if self.remaining or self.header:
+                # The connection died mid-frame: leave the partial frame out of the index
+                self.index.pop()
+            index_offset = self.offset
+            for entry in self.index:
+                self.file.write(INDEX.pack(*entry))
+            self.file.write(TRAILER.pack(index_offset, len(self.index), INDEX_MAGIC))
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class RecordingSocket(object):
+    """A socket that records everything sent through it; everything else is the wrapped socket's"""
+
+    def __init__(self, sock, recorder):
+        self.sock = sock
+        self.recorder = recorder
+
+    def sendmsg(self, buffers):
+        sent = self.sock.sendmsg(buffers)
+        remaining = sent
+        for buf in buffers:
+            if not remaining:
+                break
+            buf = memoryview(buf).cast('B')[:remaining]
+            self.recorder.write(buf)
+            remaining -= len(buf)
+        return sent
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.recorder.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class Recording(object):
+    """A recording, memory-mapped read-only.
+
+    offsets, lengths and times are arrays over all frames (times in
+    seconds after the recording started); frame(i) is the wire bytes of
+    frame i and read(i) its (FrameHeader, payload), both views into the
+    mapping with nothing copied.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise RecordingError('{0} is too short to be a recording'.format(path))
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.data = memoryview(self.map)
+        magic, version, self.start = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise RecordingError('{0} is not a stream recording'.format(path))
+        if version != VERSION:
+            raise RecordingError('Unsupported recording version {0}'.format(version))
+        self.complete = True
+        index = self._read_index()
+        if index is None:
+            self.complete = False
+            index = self._scan()
+        self.offsets = index['offset'].astype(np.int64)
+        self.lengths = index['length'].astype(np.int64)
+        self.times = index['time'].astype(np.float64)
+
+    def _read_index(self):
+        if len(self.data) < HEADER.size + TRAILER.size:
+            return None
+        end = len(self.data) - TRAILER.size
+        offset, count, magic = TRAILER.unpack_from(self.data, end)
+        if magic != INDEX_MAGIC or offset + count * INDEX.size != end:
+            return None
+        return np.frombuffer(self.data, dtype = INDEX_DTYPE, count = count, offset = offset)
+
+    def _scan(self):
+        """Index rebuilt from the frame headers of a recording that was never closed"""
+        entries = []
+        offset = HEADER.size
+        while offset + protocol.HEADER.size <= len(self.data):
+            try:
+                header = protocol.parse_header(self.data[offset:offset + protocol.HEADER.size])
+            except protocol.ProtocolError:
+                break
+            length = protocol.HEADER.size + header.length
+            if offset + length > len(self.data):
+                break
+            entries.append((offset, length, max(0.0, header.timestamp - self.start)))
+            offset += length
+        return np.array(entries, dtype = INDEX_DTYPE).reshape(-1)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def duration(self):
+        return float(self.times[-1] - self.times[0]) if len(self) else 0.0
+
+    def frame(self, i):
+        offset = int(self.offsets[i])
+        return self.data[offset:offset + int(self.lengths[i])]
+
+    def read(self, i):
+        frame = self.frame(i)
+        return protocol.parse_header(frame), frame[protocol.HEADER.size:]
+
+    def frames(self, types = None):
+        """(index, FrameHeader, payload) for every frame, or those whose type is in types"""
+        for i in range(len(self)):
+            header, payload = self.read(i)
+            if types is None or header.type in types:
+                yield i, header, payload
+
+    def close(self):
+        if self.map is None:
+            return
+        self.offsets = self.lengths = self.times = None
+        self.data.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass        # frames handed out are still in use; the mapping goes with the last of them
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# Replays a stream recording (screen_capture.py --record) to screen_stream.py,
+# so codec and pipeline changes can be compared on exactly the same frames.
+#
+#   python3 -m lib.replay capture.mprec --info
+#   python3 -m lib.replay capture.mprec --host raspberrypi.local
+#   python3 -m lib.replay capture.mprec --host localhost --fps 30
+#   python3 -m lib.replay capture.mprec --host localhost --max-speed
+#
+# By default every frame, heartbeats included, goes out as long after the
+# start as it did when recorded. With --fps or --max-speed only keyframes
+# and deltas are paced (control frames such as the rotation go straight
+# through, heartbeats are left out): one per period, or each as soon as the
+# receiver has acked enough of the earlier ones. Frames are sent straight
+# from the memory-mapped file.
+#
+# A recording cannot answer the receiver's keyframe requests, so after it
+# drops a delta nothing new is shown until the next recorded keyframe. With
+# the default in-flight limit of 2 (as in screen_capture.py) the receiver
+# never has to drop frames, even at --max-speed: one frame is being shown
+# while the next is decoded, and the display takes that one before acking
+# (see ReceivePipeline). A higher limit lets newer frames replace ones
+# still waiting to be shown, so replays are no longer frame for frame.
+
+import argparse
+import collections
+import socket
+import threading
+import time
+
+from . import protocol
+from .pipeline import Pacer
+from .recording import Recording
+
+CODEC_NAMES = {
+    protocol.CODEC_NONE: 'none',
+    protocol.CODEC_JPEG_ZLIB: 'jpeg (zlib)',
+    protocol.CODEC_TILES_ZLIB: 'tiles',
+    protocol.CODEC_RGB565_ZLIB: 'rgb565 (zlib)',
+    protocol.CODEC_RGB565_LZ4: 'rgb565 (lz4)',
+    protocol.CODEC_JPEG: 'jpeg',
+    protocol.CODEC_PNG: 'png',
+}
+
+FRAMES = (protocol.FRAME_KEYFRAME, protocol.FRAME_DELTA)
+
+class Replayer(object):
+    """Sends a Recording's frames on a connected socket and reads the acks.
+
+    rate is None for the recorded timing, 0 for as fast as the receiver
+    takes them or frames per second otherwise. At most max_in_flight
+    frames are sent but not acked (None for no limit); as in SendPipeline
+    the limit is ignored once no ack has come for ack_timeout seconds, or
+    startup_timeout before the first ack (a Pi still busy with the last
+    connection should not be flooded with the start of the recording).
+    """
+
+    def __init__(self, sock, recording, rate = None, max_in_flight = 2, ack_timeout = 1.0, startup_timeout = 5.0):
+        self.sock = sock
+        self.recording = recording
+        self.rate = rate
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.startup_timeout = startup_timeout
+        self.last_ack_time = time.perf_counter()
+        self.stop = threading.Event()
+        self.acks = threading.Condition()
+        self.unacked = collections.deque()  # seqs sent and not acked yet, oldest first
+        self.counters = {
+            'sent': 0,
+            'bytes': 0,
+            'acked': 0,
+            'displayed': 0,
+            'keyframe_requests': 0,
+        }
+        self.seconds = 0.0
+
+    def run(self):
+        """Send the whole recording; returns the counters"""
+        reader = threading.Thread(target = self._receive, name = 'acks')
+        reader.daemon = True
+        self.last_ack_time = time.perf_counter()
+        reader.start()
+        try:
+            self._send()
+            with self.acks:
+                self.acks.wait_for(lambda: not self.unacked or self.stop.is_set(), self.ack_timeout)
+        finally:
+            self.stop.set()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            reader.join()
+        return self.counters
+
+    def _send(self):
+        pacer = Pacer(self.rate, self.stop) if self.rate else None
+        start = time.perf_counter()
+        try:
+            self._send_frames(start, pacer)
+        finally:
+            self.seconds = time.perf_counter() - start
+
+    def _send_frames(self, start, pacer):
+        recording = self.recording
+        first = recording.times[0] if len(recording) else 0.0
+        for i in range(len(recording)):
+            header, _ = recording.read(i)
+            if self.rate is None:
+                delay = start + (recording.times[i] - first) - time.perf_counter()
+                if delay > 0 and self.stop.wait(delay):
+                    break
+            elif header.type == protocol.FRAME_HEARTBEAT:
+                continue
+            if header.type in FRAMES:
+                if pacer is not None and not pacer.wait():
+                    break
+                self._wait_in_flight()
+                with self.acks:
+                    self.unacked.append(header.seq)
+            frame = recording.frame(i)
+            self.sock.sendall(frame)
+            self.counters['bytes'] += len(frame)
+            if header.type in FRAMES:
+                self.counters['sent'] += 1
+
+    def _wait_in_flight(self):
+        if self.max_in_flight is None:
+            return
+        with self.acks:
+            timeout = self.ack_timeout if self.counters['acked'] else self.startup_timeout
+            self.acks.wait_for(lambda: len(self.unacked) < self.max_in_flight or self.stop.is_set(),
+                               max(0.0, self.last_ack_time + timeout - time.perf_counter()))
+
+    def _receive(self):
+        reader = protocol.FrameReader(self.sock)
+        while not self.stop.is_set():
+            try:
+                header, payload = reader.read()
+            except OSError:
+                return
+            if header is None:
+                return
+            if header.type != protocol.FRAME_CONTROL or not payload:
+                continue
+            if payload[0] == protocol.CONTROL_REQUEST_KEYFRAME:
+                self.counters['keyframe_requests'] += 1
+            elif payload[0] == protocol.CONTROL_ACK:
+                seq, displayed, _, _ = protocol.parse_ack(payload)
+                self.on_ack(seq, displayed)
+
+    def on_ack(self, seq, displayed):
+        with self.acks:
+            # Acks are cumulative: everything up to seq (32-bit wrapping) is done
+            while self.unacked and (seq - self.unacked[0]) & 0xFFFFFFFF < 0x80000000:
+                self.unacked.popleft()
+            self.last_ack_time = time.perf_counter()
+            self.acks.notify_all()
+        self.counters['acked'] += 1
+        if displayed:
+            self.counters['displayed'] += 1
+
+def describe(recording):
+    """A few lines about what is in a recording"""
+    types = collections.Counter()
+    codecs = collections.Counter()
+    sizes = collections.Counter()
+    payload_bytes = 0
+    for _, header, payload in recording.frames():
+        types[header.type] += 1
+        if header.type in FRAMES:
+            codecs[CODEC_NAMES.get(header.codec, str(header.codec))] += 1
+            sizes['{0}x{1}'.format(header.width, header.height)] += 1
+            payload_bytes += len(payload)
+    frames = types[protocol.FRAME_KEYFRAME] + types[protocol.FRAME_DELTA]
+    duration = recording.duration()
+    lines = [
+        '{0}: {1} frames ({2} keyframes, {3} deltas), {4} heartbeats, {5} control frames{6}'.format(
+            recording.path, frames, types[protocol.FRAME_KEYFRAME], types[protocol.FRAME_DELTA],
+            types[protocol.FRAME_HEARTBEAT], types[protocol.FRAME_CONTROL],
+            '' if recording.complete else ' (no index, recording was not closed)'),
+        'Recorded {0} over {1:.1f} s ({2:.1f} fps), {3:.0f} bytes per frame'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(recording.start)), duration,
+            frames / duration if duration else 0.0, payload_bytes / frames if frames else 0.0),
+        'Codecs: ' + ', '.join('{0} {1}'.format(name, n) for name, n in codecs.most_common()),
+        'Sizes: ' + ', '.join('{0} {1}'.format(size, n) for size, n in sizes.most_common()),
+    ]
+    return '\n'.join(lines)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Replay a screen_capture.py --record file to screen_stream.py.')
+    parser.add_argument('recording', help = 'Recording file')
+    parser.add_argument('--host', help = 'Address of the Pi running screen_stream.py (e.g. raspberrypi.local)')
+    parser.add_argument('--port', type = int, default = 5000, help = 'Port number (default: 5000)')
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument('--fps', type = float, help = 'Send frames at this rate instead of as recorded')
+    speed.add_argument('--max-speed', action = 'store_true',
+                       help = 'Send frames as fast as the Pi acknowledges them')
+    parser.add_argument('--max-in-flight', type = int, default = 2,
+                        help = 'Frames sent but not yet shown by the Pi before waiting; 0 for no limit (default: 2)')
+    parser.add_argument('--info', action = 'store_true', help = 'Describe the recording and exit')
+    args = parser.parse_args(argv)
+
+    if not args.host and not args.info:
+        parser.error('--host is needed to replay')
+    with Recording(args.recording) as recording:
+        print(describe(recording))
+        if args.info:
+            return
+        rate = 0 if args.max_speed else args.fps
+        with socket.create_connection((args.host, args.port)) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            replayer = Replayer(sock, recording, rate, args.max_in_flight or None)
+            try:
+                counters = replayer.run()
+            except (BrokenPipeError, ConnectionResetError):
+                print('Connection lost')
+                counters = replayer.counters
+        seconds = replayer.seconds or float('nan')
+        print('Sent {sent} frames ({bytes} bytes) in {0:.1f} s, {1:.1f} fps; {acked} acked, {displayed} displayed, '
+              '{keyframe_requests} keyframe requests'.format(seconds, counters['sent'] / seconds, **counters))
+
+if __name__ == '__main__':
+    main()
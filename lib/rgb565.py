@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# RGB888 -> RGB565 conversion shared by all LCD_* drivers.
+#
+# The panels take 16-bit pixels, high byte first:
+#   byte 0 = RRRRRGGG
+#   byte 1 = GGGBBBBB
+#
+# or, in 12-bit mode (COLMOD 0x03, see RGB444), two pixels in three bytes:
+#   RRRRGGGG BBBBRRRR GGGGBBBB
+#
+# Run "python3 -m lib.rgb565" to compare against the per-driver code this
+# module replaced, and the SPI frame rate of both pixel formats.
+
+import time
+import numpy as np
+
+RGB = (0, 1, 2)
+BGR = (2, 1, 0)      # also BGRA, e.g. an mss screenshot
+
+class RGB565(object):
+    """Packs RGB888 frames into a reused, preallocated RGB565 buffer.
+
+    One set of buffers is kept per frame layout (height, width), so a panel
+    that alternates between portrait and landscape frames allocates twice
+    and never again. The array returned by pack() is overwritten by the
+    next pack() of the same size.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def buffers(self, height, width):
+        """Return (out, planes, tmp) for a height x width frame, allocating on first use"""
+        key = (height, width)
+        bufs = self._buffers.get(key)
+        if bufs is None:
+            out = np.empty((height, width, 2), dtype = np.uint8)
+            planes = np.empty((3, height, width), dtype = np.uint8)
+            tmp = np.empty((height, width), dtype = np.uint8)
+            bufs = self._buffers[key] = (out, planes, tmp)
+        return bufs
+
+    def pack(self, img, order = RGB):
+        """Convert an RGB image (PIL image or HxWx3/HxWx4 uint8 array) to HxWx2 RGB565.
+
+        order gives the channel index of red, green and blue in img.
+        """
+        img = np.asarray(img)
+        height, width = img.shape[:2]
+        out, planes, tmp = self.buffers(height, width)
+        r, g, b = planes
+
+        # De-interleave once so every shift/mask below runs on contiguous memory
+        np.copyto(r, img[..., order[0]])
+        np.copyto(g, img[..., order[1]])
+        np.copyto(b, img[..., order[2]])
+
+        # High byte: RRRRRGGG (written back into the red plane)
+        np.bitwise_and(r, 0xF8, out = r)
+        np.right_shift(g, 5, out = tmp)
+        np.bitwise_or(r, tmp, out = r)
+
+        # Low byte: GGGBBBBB (written back into the green plane)
+        np.left_shift(g, 3, out = g)
+        np.bitwise_and(g, 0xE0, out = g)
+        np.right_shift(b, 3, out = tmp)
+        np.bitwise_or(g, tmp, out = g)
+
+        np.copyto(out[..., 0], r)
+        np.copyto(out[..., 1], g)
+        return out
+
+class RGB444(object):
+    """Packs frames into 12-bit RGB444 for the panels' COLMOD 0x03 mode.
+
+    Every pixel is the top four bits of red, green and blue in that order,
+    so once the channels are interleaved as RGB, output byte i is simply the
+    high nibbles of channel bytes 2i and 2i+1. pack() takes the same RGB888
+    input as RGB565.pack() and also HxWx2 RGB565 frames, and returns a flat
+    array of ceil(3 * pixels / 2) bytes that is overwritten by the next
+    pack() of the same size. An odd pixel count ends in half a group, which
+    the panel never completes; send even counts (see ShowRegion).
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def buffers(self, height, width):
+        """Return (rgb, out, tmp) for a height x width frame, allocating on first use"""
+        key = (height, width)
+        bufs = self._buffers.get(key)
+        if bufs is None:
+            # Odd pixel counts end in half a byte; rgb gets a zero pad channel for it
+            size = height * width * 3
+            rgb = np.zeros(size + size % 2, dtype = np.uint8)
+            out = np.empty(len(rgb) // 2, dtype = np.uint8)
+            tmp = np.empty_like(out)
+            bufs = self._buffers[key] = (rgb, out, tmp)
+        return bufs
+
+    def pack(self, img, order = RGB):
+        img = np.asarray(img)
+        height, width = img.shape[:2]
+        rgb, out, tmp = self.buffers(height, width)
+        r, g, b = np.moveaxis(rgb[:height * width * 3].reshape(height, width, 3), 2, 0)
+
+        # Only the high nibble of each channel byte is used below
+        if img.shape[2] == 2:
+            hi = img[..., 0]                    # RRRRRGGG
+            lo = img[..., 1]                    # GGGBBBBB
+            np.copyto(r, hi)
+            np.left_shift(hi, 5, out = g)
+            np.right_shift(lo, 3, out = b)
+            np.bitwise_and(b, 0x10, out = b)
+            np.bitwise_or(g, b, out = g)
+            np.left_shift(lo, 3, out = b)
+        else:
+            np.copyto(r, img[..., order[0]])
+            np.copyto(g, img[..., order[1]])
+            np.copyto(b, img[..., order[2]])
+
+        np.bitwise_and(rgb[0::2], 0xF0, out = out)
+        np.right_shift(rgb[1::2], 4, out = tmp)
+        np.bitwise_or(out, tmp, out = out)
+        return out
+
+def unpack(pix):
+    """Expand an HxWx2 RGB565 array back to HxWx3 RGB888 (pack(unpack(p)) == p)"""
+    hi = pix[..., 0]
+    lo = pix[..., 1]
+    rgb = np.empty(pix.shape[:2] + (3,), dtype = np.uint8)
+    r = hi & 0xF8
+    g = ((hi & 0x07) << 5) | ((lo & 0xE0) >> 3)
+    b = (lo & 0x1F) << 3
+    rgb[..., 0] = r | (r >> 5)
+    rgb[..., 1] = g | (g >> 6)
+    rgb[..., 2] = b | (b >> 5)
+    return rgb
+
+def _legacy_pack(img):
+    """The conversion every driver used to carry, kept for benchmark()"""
+    img = np.asarray(img)
+    pix = np.zeros((img.shape[0], img.shape[1], 2), dtype = np.uint8)
+    pix[...,[0]] = np.add(np.bitwise_and(img[...,[0]],0xF8),np.right_shift(img[...,[1]],5))
+    pix[...,[1]] = np.add(np.bitwise_and(np.left_shift(img[...,[1]],3),0xE0),np.right_shift(img[...,[2]],3))
+    return pix
+
+def benchmark(width = 240, height = 320, frames = 200):
+    """Time legacy vs. preallocated conversion; returns ms per frame for each"""
+    img = np.random.randint(0, 256, (height, width, 3), dtype = np.uint8)
+    packer = RGB565()
+    if not np.array_equal(_legacy_pack(img), packer.pack(img)):
+        raise AssertionError('RGB565 output differs from the legacy conversion')
+
+    results = {}
+    for name, func in (('legacy', _legacy_pack), ('rgb565', packer.pack)):
+        start = time.perf_counter()
+        for _ in range(frames):
+            func(img)
+        results[name] = (time.perf_counter() - start) * 1000 / frames
+    return results
+
+def benchmark_formats(width = 240, height = 320, spi_hz = 40000000, frames = 200):
+    """Pack time and SPI-bound frame rate of RGB565 and RGB444 for one panel size.
+
+    Returns {format: (pack ms, SPI bytes, fps)}, where fps counts packing
+    plus the pixel bytes at spi_hz and nothing else.
+    """
+    img = np.random.randint(0, 256, (height, width, 3), dtype = np.uint8)
+    results = {}
+    for name, packer in (('rgb565', RGB565()), ('rgb444', RGB444())):
+        size = packer.pack(img).nbytes
+        start = time.perf_counter()
+        for _ in range(frames):
+            packer.pack(img)
+        pack = (time.perf_counter() - start) / frames
+        results[name] = (pack * 1000, size, 1 / (pack + size * 8.0 / spi_hz))
+    return results
+
+if __name__ == '__main__':
+    for w, h in ((160, 80), (240, 240), (240, 320)):
+        r = benchmark(w, h)
+        print('{0}x{1}: legacy {2:.3f} ms, rgb565 {3:.3f} ms ({4:.2f}x)'.format(
+            w, h, r['legacy'], r['rgb565'], r['legacy'] / r['rgb565']))
+    for w, h in ((160, 80), (240, 240), (240, 320)):
+        r = benchmark_formats(w, h)
+        print('{0}x{1} at 40 MHz: '.format(w, h) + ', '.join(
+            '{0} {1:.3f} ms + {2} bytes = {3:.1f} fps'.format(name, *r[name]) for name in r))
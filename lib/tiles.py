@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# Dirty-tile delta frames: only the tiles that changed since the previous
+# frame are sent, with their coordinates, and composited on the Pi.
+#
+# Payload layout (all big-endian):
+#   'TILE' width height count
+#   count x (x y w h, then w*h*3 bytes of RGB)
+
+import struct
+import numpy as np
+
+MAGIC = b'TILE'
+TILE_SIZE = 16
+HEADER = struct.Struct('>4sHHH')
+RECT = struct.Struct('>HHHH')
+RGB = [0, 1, 2]
+
+class TileEncoder(object):
+    """Sender side: keeps the previous frame and emits changed tiles."""
+
+    def __init__(self, tile_size = TILE_SIZE):
+        self.tile_size = tile_size
+        self.prev = None
+
+    def reset(self):
+        """Forget the previous frame so the next encode() asks for a keyframe"""
+        self.prev = None
+
+    def changed_tiles(self, frame):
+        """Return (x, y, w, h) rectangles covering the tiles that differ from the previous frame.
+
+        Changed tiles that are next to each other in a tile row are returned
+        as one rectangle.
+        """
+        ts = self.tile_size
+        height, width = frame.shape[:2]
+        rows = -(-height // ts)
+        cols = -(-width // ts)
+
+        diff = np.any(frame != self.prev, axis = 2)
+        if height % ts or width % ts:
+            padded = np.zeros((rows * ts, cols * ts), dtype = bool)
+            padded[:height, :width] = diff
+            diff = padded
+        dirty = diff.reshape(rows, ts, cols, ts).any(axis = (1, 3))
+
+        rects = []
+        for ty, tx in zip(*np.nonzero(dirty)):
+            x, y = int(tx) * ts, int(ty) * ts
+            w, h = min(ts, width - x), min(ts, height - y)
+            if rects and rects[-1][1] == y and rects[-1][0] + rects[-1][2] == x:
+                px, py, pw, ph = rects[-1]
+                rects[-1] = (px, py, pw + w, ph)
+            else:
+                rects.append((x, y, w, h))
+        return rects
+
+    def encode(self, frame, keyframe = False, order = RGB, max_dirty = 1.0):
+        """Encode an HxWx3 (or HxWx4) frame as a delta against the previous one.
+
+        order gives the channel index of red, green and blue in frame; tiles
+        are always sent as RGB. Returns None when a keyframe has to be sent
+        instead: first frame, size change, keyframe requested, or more than
+        max_dirty of the frame changed. The frame is remembered either way.
+        """
+        frame = np.asarray(frame)[..., :3]
+        if keyframe or self.prev is None or self.prev.shape != frame.shape:
+            self.prev = frame.copy()
+            return None
+
+        rects = self.changed_tiles(frame)
+        height, width = frame.shape[:2]
+        np.copyto(self.prev, frame)
+        if sum(w * h for x, y, w, h in rects) > max_dirty * width * height:
+            return None
+
+        order = list(order)
+        parts = [HEADER.pack(MAGIC, width, height, len(rects))]
+        for x, y, w, h in rects:
+            tile = frame[y:y + h, x:x + w]
+            if order != RGB:
+                tile = tile[..., order]
+            parts.append(RECT.pack(x, y, w, h))
+            parts.append(tile.tobytes())
+        return b''.join(parts)
+
+def apply_delta(canvas, data):
+    """Composite a tile payload onto canvas (HxWx3 uint8) in place; returns the rectangles"""
+    magic, width, height, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a tile payload')
+    if (height, width) != canvas.shape[:2]:
+        raise ValueError('Delta is {0}x{1}, canvas is {2}x{3}'
+            .format(width, height, canvas.shape[1], canvas.shape[0]))
+    offset = HEADER.size
+    rects = []
+    for _ in range(count):
+        x, y, w, h = RECT.unpack_from(data, offset)
+        offset += RECT.size
+        size = w * h * 3
+        tile = np.frombuffer(data, dtype = np.uint8, count = size, offset = offset)
+        canvas[y:y + h, x:x + w] = tile.reshape(h, w, 3)
+        offset += size
+        rects.append((x, y, w, h))
+    return rects
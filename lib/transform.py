@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+# Capture transform for screen_capture.py: rotate and resize an mss BGRA
+# capture to the panel size in one vectorised pass.
+#
+# Everything that depends only on the capture size, rotation and target
+# size (index maps, weights, scratch buffers) is worked out once, so each
+# frame is a gather or a few strided adds straight from the BGRA buffer.
+# Rotation is folded into the index maps or done with array transposes.
+#
+# Resampling:
+#   box       exact average of factor x factor blocks; only for integer
+#             factors (e.g. a 2x Retina capture), otherwise PIL's BOX filter.
+#             A small margin beyond the multiple is centre-cropped first, so
+#             a 484 px Retina capture of a 242 px region becomes 480 -> 240.
+#   nearest   one source pixel per output pixel, fastest
+#   bilinear  four-pixel interpolation
+#   lanczos   PIL, best quality, slowest (what this script used to do)
+#   auto      box; PIL's BOX filter does non-integer factors fastest
+#
+# Run "python3 -m lib.transform" to compare against the old PIL path.
+
+import time
+import numpy as np
+from PIL import Image
+from . import rgb565
+
+RESAMPLE = ('auto', 'box', 'nearest', 'bilinear', 'lanczos')
+OUTPUTS = ('bgr', 'rgb', 'rgb565')
+
+# Largest margin, as a fraction of the capture size, that box/auto crop off
+# to reach a whole multiple of the target size
+MAX_CROP = 1 / 32
+
+class CaptureTransform(object):
+    """Turns width x height BGRA captures into target-size frames.
+
+    rotation is counter-clockwise in degrees, like PIL's rotate(), and
+    must be a multiple of 90; the target size is after rotation. Calling
+    the transform with the raw capture buffer returns (frame, order) as
+    expected by the codecs. Every call returns a new frame array (frames
+    are handed to the encoder thread while the next one is captured);
+    only scratch memory is reused.
+
+    output picks what the frame is made of, converted in the same pass
+    that writes the frame: 'bgr' (no conversion, and no copy at all when
+    nothing needs resizing or rotating), 'rgb' for the image codecs, or
+    'rgb565', an HxWx2 panel-format array for the rgb565 codec.
+    """
+
+    def __init__(self, width, height, rotation, target_width, target_height, resample = 'auto',
+                 output = 'bgr'):
+        if rotation % 90:
+            raise ValueError('Rotation must be a multiple of 90 degrees, not {0}'.format(rotation))
+        if resample not in RESAMPLE:
+            raise ValueError('Unknown resampling {0!r}, expected one of {1}'.format(resample, ', '.join(RESAMPLE)))
+        if output not in OUTPUTS:
+            raise ValueError('Unknown output {0!r}, expected one of {1}'.format(output, ', '.join(OUTPUTS)))
+        self.output = output
+        self.width = width
+        self.height = height
+        self.turns = rotation % 360 // 90
+        self.target_width = target_width
+        self.target_height = target_height
+        # Size to resize to before rotating
+        if self.turns % 2:
+            self.resize_width, self.resize_height = target_height, target_width
+        else:
+            self.resize_width, self.resize_height = target_width, target_height
+
+        # A capture a few pixels bigger than a whole multiple of the target
+        # (a margin around the region) is centre-cropped to the multiple
+        margin_x, margin_y = _margin(width, self.resize_width), _margin(height, self.resize_height)
+        integer = resample in ('auto', 'box') and margin_x is not None and margin_y is not None
+        self.crop_x = margin_x // 2 if integer else 0
+        self.crop_y = margin_y // 2 if integer else 0
+        if resample == 'auto':
+            resample = 'box' if integer else 'pil-box'
+        if resample == 'box' and not integer:
+            resample = 'pil-box'
+        self.resample = resample
+        if integer:
+            width = self.width - 2 * self.crop_x
+            height = self.height - 2 * self.crop_y
+            width -= width % self.resize_width
+            height -= height % self.resize_height
+        self.crop_width, self.crop_height = width, height
+
+        if (width, height) == (self.resize_width, self.resize_height):
+            self._convert = self._rotate_only
+        elif resample == 'box':
+            self._setup_box()
+            self._convert = self._box
+        elif resample == 'nearest':
+            self._setup_nearest()
+            self._convert = self._nearest
+        elif resample == 'bilinear':
+            self._setup_bilinear()
+            self._convert = self._bilinear
+        else:
+            self.pil_filter = Image.LANCZOS if resample == 'lanczos' else Image.BOX
+            self._convert = self._pil
+
+    def __call__(self, raw):
+        bgra = np.frombuffer(raw, dtype = np.uint8).reshape(self.height, self.width, 4)
+        if (self.crop_width, self.crop_height) != (self.width, self.height):
+            bgra = bgra[self.crop_y:self.crop_y + self.crop_height, self.crop_x:self.crop_x + self.crop_width]
+        return self._convert(bgra)
+
+    def scale(self):
+        """Integer reduction factors (x, y) of the box fast path, or None"""
+        if self.resample != 'box':
+            return None
+        return self.crop_width // self.resize_width, self.crop_height // self.resize_height
+
+    def _finish(self, pixels, rotate = True):
+        """Write BGR(A) pixels (uint8 or uint16 holding 0-255) to a new frame in the output format"""
+        if rotate and self.turns:
+            pixels = np.rot90(pixels, self.turns)
+        if self.output == 'rgb565':
+            return self._pack(pixels), rgb565.RGB
+        out = np.empty((self.target_height, self.target_width, 3), dtype = np.uint8)
+        if self.output == 'rgb':
+            np.copyto(out, pixels[..., 2::-1], casting = 'unsafe')
+            return out, rgb565.RGB
+        np.copyto(out, pixels[..., :3], casting = 'unsafe')
+        return out, rgb565.BGR
+
+    def _pack(self, pixels):
+        """Big-endian RGB565 from BGR(A) pixels, built in reused 16-bit scratch planes"""
+        shape = pixels.shape[:2]
+        if getattr(self, 'words', None) is None or self.words.shape != shape:
+            self.words = np.empty(shape, dtype = np.uint16)
+            self.word_tmp = np.empty(shape, dtype = np.uint16)
+        word, tmp = self.words, self.word_tmp
+        np.bitwise_and(pixels[..., 2], 0xF8, out = word, casting = 'unsafe')
+        word <<= 8
+        np.bitwise_and(pixels[..., 1], 0xFC, out = tmp, casting = 'unsafe')
+        tmp <<= 3
+        word |= tmp
+        np.right_shift(pixels[..., 0], 3, out = tmp, casting = 'unsafe')
+        word |= tmp
+        out = np.empty((self.target_height, self.target_width, 2), dtype = np.uint8)
+        np.copyto(out.view('>u2')[..., 0], word)
+        return out
+
+    def _rotated_index(self, index):
+        """Rotate a resize-size map so one gather gives the rotated frame"""
+        return np.ascontiguousarray(np.rot90(index, self.turns))
+
+    def _rotate_only(self, bgra):
+        if self.turns == 0 and self.output == 'bgr':
+            # Nothing to transform: encode straight from the capture buffer
+            return bgra, rgb565.BGR
+        return self._finish(bgra)
+
+    def _setup_box(self):
+        self.fx = self.crop_width // self.resize_width
+        self.fy = self.crop_height // self.resize_height
+        n = self.fx * self.fy
+        dtype = np.uint16 if n * 255 + n // 2 < 65536 else np.uint32
+        self.rows = np.empty((self.resize_height, self.crop_width, 4), dtype = dtype)
+        self.acc = np.empty((self.resize_height, self.resize_width, 4), dtype = dtype)
+        self.half = n // 2
+        self.count = n
+        self.shift = n.bit_length() - 1 if n & (n - 1) == 0 else None
+
+    def _box(self, bgra):
+        # Rows first, then columns; whole BGRA pixels keep the adds contiguous
+        rows, acc = self.rows, self.acc
+        fx, fy = self.fx, self.fy
+        np.copyto(rows, bgra[0::fy])
+        for dy in range(1, fy):
+            np.add(rows, bgra[dy::fy], out = rows)
+        np.copyto(acc, rows[:, 0::fx])
+        for dx in range(1, fx):
+            np.add(acc, rows[:, dx::fx], out = acc)
+        acc += self.half
+        if self.shift is not None:
+            acc >>= self.shift
+        else:
+            acc //= self.count
+        return self._finish(acc)
+
+    def _centres(self, size, target):
+        """Source coordinates of the target pixel centres along one axis"""
+        return (np.arange(target) + 0.5) * (size / target) - 0.5
+
+    def _gather(self, bgra, index, out):
+        """out[...] = the BGRA pixels at flat index, moved as whole 32-bit words"""
+        pixels = bgra.reshape(-1, 4).view(np.uint32).reshape(-1)
+        np.take(pixels, index, out = out)
+        return out.view(np.uint8).reshape(out.shape + (4,))
+
+    def _setup_nearest(self):
+        ys = np.clip(np.round(self._centres(self.height, self.resize_height)), 0, self.height - 1).astype(np.intp)
+        xs = np.clip(np.round(self._centres(self.width, self.resize_width)), 0, self.width - 1).astype(np.intp)
+        self.index = self._rotated_index(ys[:, None] * self.width + xs[None, :])
+        self.gathered = np.empty(self.index.shape, dtype = np.uint32)
+
+    def _nearest(self, bgra):
+        return self._finish(self._gather(bgra, self.index, self.gathered), rotate = False)
+
+    def _setup_bilinear(self):
+        def axis(size, target):
+            pos = np.clip(self._centres(size, target), 0, size - 1)
+            lo = np.floor(pos).astype(np.intp)
+            hi = np.minimum(lo + 1, size - 1)
+            return lo, hi, pos - lo
+        y0, y1, wy = axis(self.height, self.resize_height)
+        x0, x1, wx = axis(self.width, self.resize_width)
+        w = self.width
+        self.corners = [self._rotated_index(ys[:, None] * w + xs[None, :])
+                        for ys in (y0, y1) for xs in (x0, x1)]
+        # 7-bit fixed point weights summing to exactly 128, so 255 * 128 fits in uint16
+        wy, wx = wy[:, None], wx[None, :]
+        weights = [np.floor(weight * 128).astype(np.uint16)
+                   for weight in ((1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx))]
+        weights.append(128 - sum(weights))
+        self.weights = [self._rotated_index(weight)[..., None] for weight in weights]
+        self.gathered = np.empty(self.corners[0].shape, dtype = np.uint32)
+        self.acc = np.empty((self.target_height, self.target_width, 4), dtype = np.uint16)
+        self.tmp = np.empty_like(self.acc)
+
+    def _bilinear(self, bgra):
+        acc, tmp = self.acc, self.tmp
+        acc.fill(64)            # rounds to nearest in the shift below
+        for index, weight in zip(self.corners, self.weights):
+            pixels = self._gather(bgra, index, self.gathered)
+            np.multiply(pixels, weight, out = tmp)
+            acc += tmp
+        acc >>= 7
+        return self._finish(acc, rotate = False)
+
+    def _pil(self, bgra):
+        image = Image.frombuffer('RGB', (self.width, self.height), np.ascontiguousarray(bgra),
+                                 'raw', 'BGRX', 0, 1)
+        image = image.resize((self.resize_width, self.resize_height), self.pil_filter)
+        if self.turns:
+            image = image.transpose((None, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270)[self.turns])
+        if self.output == 'rgb565':
+            return self._finish(np.asarray(image)[..., ::-1], rotate = False)
+        return np.asarray(image), rgb565.RGB
+
+def _margin(size, target):
+    """Pixels left over above a whole multiple of target, or None if too many to crop"""
+    if size < target:
+        return None
+    margin = size % target
+    return margin if margin <= size * MAX_CROP else None
+
+def _legacy_transform(bgra, rotation, target_width, target_height):
+    """The per-frame PIL path screen_capture.py used to take, kept for benchmark()"""
+    height, width = bgra.shape[:2]
+    rgb = bgra[..., 2::-1].tobytes()
+    image = Image.frombytes('RGB', (width, height), rgb)
+    image = image.rotate(rotation, expand = True)
+    image = image.resize((target_width, target_height), Image.LANCZOS)
+    return np.asarray(image)
+
+def benchmark(width = 484, height = 484, rotation = 90, target_width = 240, target_height = 240,
+              output = 'rgb', frames = 100):
+    """Time the old PIL path against each resampling; returns ms per frame by name"""
+    bgra = np.random.randint(0, 256, (height, width, 4), dtype = np.uint8)
+    raw = bgra.tobytes()
+    packer = rgb565.RGB565()
+    results = {}
+    start = time.perf_counter()
+    for _ in range(frames):
+        frame = _legacy_transform(bgra, rotation, target_width, target_height)
+        if output == 'rgb565':
+            packer.pack(frame)
+    results['legacy'] = (time.perf_counter() - start) * 1000 / frames
+    for resample in RESAMPLE:
+        transform = CaptureTransform(width, height, rotation, target_width, target_height, resample, output)
+        start = time.perf_counter()
+        for _ in range(frames):
+            transform(raw)
+        results[resample] = (time.perf_counter() - start) * 1000 / frames
+    return results
+
+if __name__ == '__main__':
+    for output in ('rgb', 'rgb565'):
+        for size in ((480, 480), (484, 484), (242, 242)):
+            r = benchmark(*size, output = output)
+            print('{0}x{1} -> 240x240 {2}, rotated 90: '.format(size[0], size[1], output) + ', '.join(
+                '{0} {1:.2f} ms'.format(name, ms) for name, ms in r.items()))
@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# Virtual SPI/GPIO stand-in for the LCD panels, for profiling and testing
+# the drivers off the Pi.
+#
+# VirtualPanel takes the place of the spidev device and decodes the command
+# stream the way the controller would: CASET (0x2A) and RASET (0x2B) set the
+# window, MADCTL (0x36) the address mapping, COLMOD (0x3A) the pixel format,
+# and RAMWR (0x2C) data lands in an in-memory copy of the frame memory.
+# VirtualGPIO provides the RST/DC/backlight pins; DC tells the panel whether
+# a byte is a command or data.
+#
+# Everything sent is counted, and seconds() turns the counts into the time
+# the same traffic would take on real hardware:
+#
+#   bytes * 8 / spi_hz + transfers * transfer_overhead + gpio writes * gpio_overhead
+#
+# The overheads default to rough figures for a Pi 4 (one spidev ioctl,
+# one lgpio write) and are meant to be adjusted to match a measured device.
+#
+#   from lib import virtual, LCD_1inch54
+#   disp = virtual.make_display(LCD_1inch54.LCD_1inch54)
+#   disp.Init()
+#   disp.ShowImage(image)
+#   disp.panel.image()         # what the glass shows, as an HxWx3 array
+#   disp.panel.stats()
+
+import numpy as np
+from . import lcdconfig
+from . import rgb565
+
+SPI_HZ = 40000000
+TRANSFER_OVERHEAD = 20e-6   # seconds per spidev transfer (syscall + setup)
+GPIO_OVERHEAD = 2e-6        # seconds per GPIO write
+
+# Bytes per pixel group and pixels per group for each COLMOD value (low 3 bits)
+PIXEL_FORMATS = {0x05: (2, 1), 0x03: (3, 2)}
+
+class VirtualPin(object):
+    """Output/input pin with gpiozero's on()/off()/value interface"""
+
+    def __init__(self, gpio, pin, initial_value = False):
+        self.gpio = gpio
+        self.pin = pin
+        self.value = int(bool(initial_value))
+        self.frequency = None
+
+    def on(self):
+        self.gpio.write(self, 1)
+
+    def off(self):
+        self.gpio.write(self, 0)
+
+    def close(self):
+        pass
+
+class VirtualGPIO(object):
+    """GPIO backend (see lcdconfig.GPIO_BACKENDS) whose pins only record their level"""
+
+    def __init__(self):
+        self.pins = {}
+        self.writes = 0
+        self.toggles = {}
+
+    def output(self, pin, initial_value = False):
+        return self._pin(pin, initial_value)
+
+    def input(self, pin, pull_up = None, active_state = True):
+        return self._pin(pin, False)
+
+    def pwm(self, pin, frequency):
+        p = self._pin(pin, False)
+        p.frequency = frequency
+        return p
+
+    def close(self):
+        pass
+
+    def write(self, pin, value):
+        self.writes += 1
+        if pin.value != value:
+            self.toggles[pin.pin] = self.toggles.get(pin.pin, 0) + 1
+        pin.value = value
+
+    def _pin(self, pin, initial_value):
+        p = self.pins[pin] = VirtualPin(self, pin, initial_value)
+        return p
+
+class VirtualPanel(object):
+    """Stands in for spidev.SpiDev and decodes what is written into frame memory.
+
+    memory is the controller's (columns, rows), as in the drivers' MEMORY.
+    gpio and dc name the backend and pin number that carry DC. bufsiz is
+    the largest transfer, as with the spidev module parameter; writebytes2
+    splits longer writes the same way. With decode = False pixel data is
+    only counted, not stored, so timing the driver does not time the model.
+    """
+
+    def __init__(self, memory, gpio, dc = 25, spi_hz = None, transfer_overhead = TRANSFER_OVERHEAD,
+                 gpio_overhead = GPIO_OVERHEAD, bufsiz = lcdconfig.SPIDEV_BUFSIZ_DEFAULT, decode = True):
+        self.memory = memory
+        self.gpio = gpio
+        self.dc = dc
+        self.spi_hz = spi_hz
+        self.transfer_overhead = transfer_overhead
+        self.gpio_overhead = gpio_overhead
+        self.bufsiz = bufsiz
+        self.decode = decode
+        self.max_speed_hz = SPI_HZ
+        self.mode = 0
+        self.display = None
+
+        columns, rows = memory
+        self.frame = np.zeros((rows, columns, 3), dtype = np.uint8)
+        self.madctl = 0x00
+        self.colmod = 0x05
+        self.columns = (0, columns - 1)
+        self.rows = (0, rows - 1)
+        self.cmd = None
+        self.params = bytearray()
+        self.pixel = 0              # pixels written since the last RAMWR
+        self.partial = b''          # bytes of a pixel group split across transfers
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {
+            'transfers': 0,
+            'bytes': 0,
+            'commands': 0,
+            'pixel_bytes': 0,
+            'windows': 0,           # RAMWR commands
+        }
+        self.gpio.writes = 0
+        self.gpio.toggles = {}
+
+    def stats(self):
+        """Counters, GPIO writes, DC toggles and the modelled seconds()"""
+        stats = dict(self.counters)
+        stats['gpio_writes'] = self.gpio.writes
+        stats['dc_toggles'] = self.gpio.toggles.get(self.dc, 0)
+        stats['seconds'] = self.seconds()
+        return stats
+
+    def seconds(self):
+        """How long the traffic counted so far would take on the real bus"""
+        spi_hz = self.spi_hz or self.max_speed_hz
+        return (self.counters['bytes'] * 8.0 / spi_hz +
+                self.counters['transfers'] * self.transfer_overhead +
+                self.gpio.writes * self.gpio_overhead)
+
+    # spidev.SpiDev interface
+
+    def writebytes(self, data):
+        self._transfer(bytes(data))
+
+    def writebytes2(self, data):
+        buf = memoryview(data).cast('B')
+        for i in range(0, len(buf), self.bufsiz):
+            self._transfer(buf[i:i + self.bufsiz])
+
+    def close(self):
+        pass
+
+    # Controller model
+
+    def _transfer(self, data):
+        self.counters['transfers'] += 1
+        self.counters['bytes'] += len(data)
+        if not self.gpio.pins[self.dc].value:
+            for cmd in bytes(data):
+                self._command(cmd)
+        elif self.cmd == 0x2C:
+            self.counters['pixel_bytes'] += len(data)
+            if self.decode:
+                self._pixels(bytes(data))
+        elif self.cmd is not None:
+            self.params += data
+            self._parameters()
+
+    def _command(self, cmd):
+        self.counters['commands'] += 1
+        self.cmd = cmd
+        self.params = bytearray()
+        if cmd == 0x2C:
+            self.counters['windows'] += 1
+            self.pixel = 0
+            self.partial = b''
+
+    def _parameters(self):
+        p = self.params
+        if self.cmd == 0x2A and len(p) >= 4:
+            self.columns = (p[0] << 8 | p[1], p[2] << 8 | p[3])
+        elif self.cmd == 0x2B and len(p) >= 4:
+            self.rows = (p[0] << 8 | p[1], p[2] << 8 | p[3])
+        elif self.cmd == 0x36 and p:
+            self.madctl = p[0]
+        elif self.cmd == 0x3A and p:
+            self.colmod = p[0]
+
+    def _pixels(self, data):
+        group, per_group = PIXEL_FORMATS.get(self.colmod & 0x07, (2, 1))
+        data = self.partial + data
+        whole = len(data) - len(data) % group
+        self.partial = data[whole:]
+        if not whole:
+            return
+        raw = np.frombuffer(data, dtype = np.uint8, count = whole)
+        if group == 2:
+            rgb = rgb565.unpack(raw.reshape(-1, 1, 2))[:, 0]
+        else:
+            # RGB444: every byte is two nibbles of the R, G, B, R, G, B... stream
+            nibbles = np.empty(whole * 2, dtype = np.uint8)
+            nibbles[0::2] = raw >> 4
+            nibbles[1::2] = raw & 0x0F
+            rgb = (nibbles * 17).reshape(-1, 3)
+        self._store(rgb)
+
+    def _store(self, rgb):
+        x0, x1 = self.columns
+        y0, y1 = self.rows
+        width, height = x1 - x0 + 1, y1 - y0 + 1
+        if width <= 0 or height <= 0:
+            return
+        # Writes past the end of the window wrap back to its start
+        k = np.arange(self.pixel, self.pixel + len(rgb)) % (width * height)
+        self.pixel += len(rgb)
+        column, row = lcdconfig.madctl_to_memory(self.madctl, self.memory, x0 + k % width, y0 + k // width)
+        columns, rows = self.memory
+        inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+        self.frame[row[inside], column[inside]] = rgb[inside]
+
+    # What the panel shows
+
+    def image(self, display = None):
+        """The visible pixels as an HxWx3 RGB array, in the panel's rotation 0 orientation.
+
+        display defaults to the driver make_display() attached; its MADCTL,
+        OFFSET and size at rotation 0 say which part of frame memory is
+        behind the glass.
+        """
+        display = display or self.display
+        width, height = display.width, display.height
+        x, y = np.meshgrid(np.arange(width), np.arange(height))
+        ox, oy = display.OFFSET
+        column, row = lcdconfig.madctl_to_memory(display.MADCTL, self.memory, x + ox, y + oy)
+        return self.frame[row, column]
+
+def make_display(cls, spi_hz = None, transfer_overhead = TRANSFER_OVERHEAD, gpio_overhead = GPIO_OVERHEAD,
+                 decode = True, **kwargs):
+    """An LCD_* driver instance wired to a VirtualPanel (display.panel) instead of hardware.
+
+    spi_hz defaults to the driver's spi_freq; other keyword arguments go to
+    the driver.
+    """
+    gpio = VirtualGPIO()
+    panel = VirtualPanel(cls.MEMORY, gpio, kwargs.get('dc', 25), spi_hz, transfer_overhead, gpio_overhead,
+                         decode = decode)
+    display = cls(spi = panel, gpio = gpio, **kwargs)
+    display.panel = panel
+    panel.display = display
+    panel.reset_counters()
+    return display
+
+if __name__ == '__main__':
+    from importlib import import_module
+    from .lcdconfig import BITS_PER_PIXEL
+
+    # Modelled full-frame rate of every driver at 40 MHz
+    for name in ('LCD_0inch96', 'LCD_1inch14', 'LCD_1inch28', 'LCD_1inch3', 'LCD_1inch47',
+                 'LCD_1inch54', 'LCD_1inch69', 'LCD_1inch8', 'LCD_1inch9', 'LCD_2inch', 'LCD_2inch4'):
+        cls = getattr(import_module('lib.' + name), name)
+        for pixel_format in sorted(BITS_PER_PIXEL):
+            if pixel_format not in cls.COLMOD:
+                continue
+            disp = make_display(cls)
+            disp.Init(pixel_format = pixel_format)
+            frame = np.random.randint(0, 256, (disp.height, disp.width, 3), dtype = np.uint8)
+            disp.panel.reset_counters()
+            disp.ShowImage(frame)
+            s = disp.panel.stats()
+            print('{0:12s} {1:7s} {2:3d}x{3:3d}: {4:6d} bytes in {5:3d} transfers, {6:.2f} ms ({7:.1f} fps)'.format(
+                name, pixel_format, disp.width, disp.height, s['bytes'], s['transfers'],
+                s['seconds'] * 1000, 1 / s['seconds']))
@@ -1,52 +1,98 @@
 import socket
-import time
+import zlib
 import argparse
 from mss import mss
 from PIL import Image
-from io import BytesIO
-import zlib
+import numpy as np
+from lib import codec
+from lib import rgb565
+from lib import control
+from lib import protocol
+from lib import recording
+from lib.pipeline import SendPipeline
+from lib.transform import CaptureTransform, RESAMPLE
 
 
-def send_image(client, image, quality, rotation, target_width, target_height):
-    image = image.rotate(rotation, expand=True)
-    image = image.resize((target_width, target_height), Image.LANCZOS)
+# Precomputed transforms by (capture size, rotation, target size, resampling)
+transforms = {}
 
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG", quality=quality, optimize=True, subsampling=0)
-    buffer.seek(0)
 
-    image_data = buffer.read()
-    compressed_data = zlib.compress(image_data)
+def prepare_frame(screenshot, rotation, target_width, target_height, resample="auto", output="rgb"):
+    """
+    Return the capture at the target size as (array, channel order of red/green/blue).
+    output is "rgb" for the image codecs or "rgb565" for panel-format frames,
+    converted straight from the BGRA capture buffer in the same pass.
+    """
+    if rotation % 90:
+        # Arbitrary angles still go through PIL
+        image = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
+        image = image.rotate(rotation, expand=True)
+        image = image.resize((target_width, target_height), Image.LANCZOS)
+        return np.asarray(image), rgb565.RGB
 
-    image_size = len(compressed_data)
-    client.sendall(image_size.to_bytes(8, byteorder="big"))
-    client.sendall(compressed_data)
+    key = (screenshot.size, rotation, target_width, target_height, resample, output)
+    transform = transforms.get(key)
+    if transform is None:
+        transform = transforms[key] = CaptureTransform(*screenshot.size, rotation, target_width, target_height,
+                                                       resample, output)
+    return transform(screenshot.raw)
 
 
-def resolve_hostname(hostname):
-    try:
-        return socket.gethostbyname(f"{hostname}.local")
-    except socket.gaierror:
-        print(f"Failed to resolve hostname: {hostname}")
-        return None
+def scale_factor(screenshot, region):
+    """Pixels captured per point of the region: 2 on a Retina display, 1 otherwise."""
+    return screenshot.size[0] / region["width"]
 
 
-def send_keep_alive(client):
-    """Send a lightweight keep-alive packet to keep the connection active."""
-    empty_frame = zlib.compress(b"")
-    client.sendall(len(empty_frame).to_bytes(8, byteorder="big"))
-    client.sendall(empty_frame)
-    print("Sent keep-alive frame.")
+def report_capture(screenshot, region, rotation, target_width, target_height, resample="auto", output="rgb"):
+    """Print the detected display scale and how captures will be resized."""
+    width, height = screenshot.size
+    print(f"Capturing {width}x{height} pixels for a {region['width']}x{region['height']} region "
+          f"(display scale {scale_factor(screenshot, region):g}x)")
+    if rotation % 90:
+        return
+    prepare_frame(screenshot, rotation, target_width, target_height, resample, output)
+    transform = transforms[(screenshot.size, rotation, target_width, target_height, resample, output)]
+    factors = transform.scale()
+    if factors is None:
+        print(f"Resizing to {target_width}x{target_height} with {transform.resample}")
+        return
+    crop = ""
+    if (transform.crop_width, transform.crop_height) != (width, height):
+        crop = f"cropped to {transform.crop_width}x{transform.crop_height}, "
+    if factors == (1, 1):
+        print(f"Capture {crop}no resizing needed")
+    else:
+        print(f"Resizing to {target_width}x{target_height}: {crop}{factors[0]}x{factors[1]} box average")
 
 
-def main(hostname, port, region, framerate, quality, rotation, target_width, target_height):
-    delay = 1 / framerate
+def resolve_hostname(hostname):
+    """
+    Address for --hostname: an IP address or a name that resolves as given
+    (e.g. localhost), otherwise the Pi's mDNS name, hostname.local.
+    """
+    names = [hostname]
+    if not hostname.endswith(".local"):
+        names.append(f"{hostname}.local")
+    for name in names:
+        try:
+            return socket.gethostbyname(name)
+        except socket.gaierror:
+            continue
+    print(f"Failed to resolve hostname: {hostname}")
+    return None
+
+
+def main(hostname, port, region, framerate, quality, rotation, target_width, target_height,
+         codec_name="jpeg", use_lz4=False, tile_size=16, keyframe_interval=5.0, max_in_flight=2,
+         adaptive=False, target_latency=None, skip_unchanged=True, idle_framerate=2.0,
+         resample="auto", hardware_rotation=False, record=None):
     host = resolve_hostname(hostname)
 
     if not host:
         print("Could not resolve the hostname. Exiting...")
         return
 
+    recorder = None
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
             client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Disable Nagle's Algorithm
@@ -54,25 +100,89 @@ def main(hostname, port, region, framerate, quality, rotation, target_width, tar
             client.connect((host, port))
             print(f"Connected to {hostname} ({host}):{port}")
 
+            # Keep everything sent, byte for byte, for replaying with lib.replay
+            sock = client
+            if record:
+                recorder = recording.Recorder(record)
+                sock = recording.RecordingSocket(client, recorder)
+
+            # Quarter turns can be done by the panel controller instead: frames
+            # go out unrotated and the Pi programs the turn once
+            panel_rotation = 0
+            if hardware_rotation:
+                if rotation % 90:
+                    print(f"The panel only turns in quarter turns; rotating {rotation} degrees here instead")
+                else:
+                    panel_rotation = rotation % 360
+                    rotation = 0
+                    protocol.send_rotation(sock, panel_rotation)
+
+            # A new connection always starts with a keyframe so the Pi can sync
+            encoder = codec.make_codec(codec_name, quality, use_lz4, tile_size)
+            last_codec = [None]
+
+            def on_sent(encoded):
+                if codec_name == "auto" and encoder.last != last_codec[0]:
+                    print(f"Codec: {encoder.last}")
+                    last_codec[0] = encoder.last
+
+            controller = None
+            if adaptive:
+                # Adjusts rate, quality, codec preference and size from the Pi's acks
+                controller = control.AdaptiveController(encoder, framerate, quality, control.can_scale(codec_name),
+                                                        target_latency, log=print)
+
+            # Frame size before the panel's turn
+            width, height = (target_height, target_width) if panel_rotation % 180 else (target_width, target_height)
+
+            def size():
+                if controller is None:
+                    return width, height
+                return control.scaled_size(width, height, controller.scale)
+
+            # Raw frames are packed to RGB565 during the resize; the rest get RGB
+            output = "rgb565" if codec_name == "rgb565" else "rgb"
+
+            def prepare(screenshot):
+                return prepare_frame(screenshot, rotation, *size(), resample, output)
+
+            def fingerprint(screenshot):
+                # A checksum of the raw BGRA buffer is far cheaper than encoding
+                return zlib.crc32(screenshot.raw), size()
+
             with mss() as sct:
-                last_send_time = time.time()
-                while True:
-                    screenshot = sct.grab(region)
-                    image = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
-                    try:
-                        send_image(client, image, quality, rotation, target_width, target_height)
-                        last_send_time = time.time()
-                    except (BrokenPipeError, ConnectionResetError):
-                        print("Connection lost. Exiting...")
-                        break
-
-                    # Send keep-alive frame if no data is sent for 1 second
-                    if time.time() - last_send_time > 1:
-                        send_keep_alive(client)
-
-                    time.sleep(delay)
+                def grab():
+                    return sct.grab(region)
+
+                report_capture(grab(), region, rotation, width, height, resample, output)
+
+                # Capture runs here at the requested framerate; encoding and sending
+                # happen on their own threads and always pick up the newest capture.
+                # Captures are skipped while max_in_flight frames await the Pi's ack,
+                # and unchanged captures are not sent at all.
+                sender = SendPipeline(sock, grab, encoder, framerate, keyframe_interval, on_sent,
+                                      max_in_flight=max_in_flight or None, controller=controller,
+                                      prepare=prepare, fingerprint=fingerprint if skip_unchanged else None,
+                                      idle_rate=idle_framerate)
+                counters = sender.run()
+
+            if isinstance(sender.error, (BrokenPipeError, ConnectionResetError)):
+                print("Connection lost. Exiting...")
+            elif sender.error is not None:
+                print(f"Error: {sender.error}")
+            print(f"Frames: {counters['captured']} captured, {counters['sent']} sent, "
+                  f"{counters['unchanged']} unchanged, {counters['capture_drops']} captures dropped, "
+                  f"{counters['in_flight_skips']} skipped waiting for acks")
+            if controller is not None:
+                state = controller.state()
+                print(f"Controller: {state['decisions']} decisions, ended at {state['rate']:.1f} fps, "
+                      f"quality {state['quality']}, scale {state['scale']:.2f}")
     except ConnectionRefusedError:
         print(f"Could not connect to {hostname}:{port}")
+    finally:
+        if recorder is not None:
+            recorder.close()
+            print(f"Recorded {len(recorder)} frames to {record}")
 
 
 if __name__ == "__main__":
@@ -88,6 +198,33 @@ if __name__ == "__main__":
     parser.add_argument("--framerate", type=float, default=10, help="Frames per second (default: 10 FPS)")
     parser.add_argument("--quality", type=int, default=50, help="JPEG quality (1-100, default: 50)")
     parser.add_argument("--rotation", type=int, default=0, help="Rotation angle in degrees (default: 0)")
+    parser.add_argument("--hardware-rotation", action="store_true",
+                        help="Have the Pi's display controller do --rotation (multiples of 90 only) "
+                             "instead of rotating every frame here")
+    parser.add_argument("--resample", choices=RESAMPLE, default="auto",
+                        help="Resizing filter: box averages whole blocks (2x Retina captures), nearest is fastest, "
+                             "lanczos is the slowest and sharpest; auto picks box (default: auto)")
+    parser.add_argument("--codec", choices=codec.CODECS, default="jpeg",
+                        help="Frame codec: auto picks per frame; jpeg, png, rgb565 (lossless, no decoding on the Pi) "
+                             "or tiles (changed tiles only, jpeg keyframes) (default: jpeg)")
+    parser.add_argument("--lz4", action="store_true", help="Compress rgb565 frames with lz4 instead of zlib")
+    parser.add_argument("--tile-size", type=int, default=16, help="Tile size in pixels for tile deltas (default: 16)")
+    parser.add_argument("--keyframe-interval", type=float, default=5.0,
+                        help="Seconds between forced keyframes when sending tile deltas (default: 5)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adjust frame rate, quality, codec and size to what the Pi and network keep up with; "
+                             "--framerate and --quality become the maximums")
+    parser.add_argument("--target-latency", type=float, default=None,
+                        help="Capture-to-display latency the adaptive controller aims for, in seconds "
+                             "(default: two frame periods, at least 0.1)")
+    parser.add_argument("--no-skip-unchanged", action="store_true",
+                        help="Send every capture, even when the screen has not changed")
+    parser.add_argument("--idle-framerate", type=float, default=2.0,
+                        help="Capture rate the sender slows down to while the screen is unchanged (default: 2 FPS)")
+    parser.add_argument("--max-in-flight", type=int, default=2,
+                        help="Frames sent but not yet shown by the Pi before captures are skipped; 0 for no limit (default: 2)")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Also write every frame sent, with its timing, to FILE for replaying with lib.replay")
 
     args = parser.parse_args()
 
@@ -107,4 +244,16 @@ if __name__ == "__main__":
         args.rotation,
         args.target_width,
         args.target_height,
+        args.codec,
+        args.lz4,
+        args.tile_size,
+        args.keyframe_interval,
+        args.max_in_flight,
+        args.adaptive,
+        args.target_latency,
+        not args.no_skip_unchanged,
+        args.idle_framerate,
+        args.resample,
+        args.hardware_rotation,
+        args.record,
     )
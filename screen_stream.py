@@ -1,17 +1,31 @@
 #!/usr/bin/python3
 import socket
 from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
 import os
 import subprocess
-import zlib
 import time
 from lib import LCD_1inch54
+from lib import codec
+from lib import protocol
+from lib import virtual
+from lib.pipeline import ReceivePipeline, format_counters
+from lib.framebuffer import ShadowFramebuffer
+
+# "rgb444" sends 12-bit pixels: a quarter fewer SPI bytes per frame, so more
+# frames per second on a busy bus, at the cost of colour depth
+PIXEL_FORMAT = "rgb565"
+
+# MACPI_VIRTUAL_DISPLAY=1 drives lib.virtual's model of the panel instead of
+# the SPI bus, so the whole receive path runs (and can be profiled) off the Pi
+VIRTUAL_DISPLAY = bool(os.environ.get("MACPI_VIRTUAL_DISPLAY"))
 
 # === DISPLAY SETUP FUNCTIONS ===
 def init_display():
-    display = LCD_1inch54.LCD_1inch54()
-    display.Init()
+    if VIRTUAL_DISPLAY:
+        display = virtual.make_display(LCD_1inch54.LCD_1inch54)
+    else:
+        display = LCD_1inch54.LCD_1inch54()
+    display.Init(pixel_format=PIXEL_FORMAT)
     return display
 
 def clear_display(display):
@@ -21,16 +35,26 @@ def set_backlight(display, brightness):
     display.bl_DutyCycle(brightness)
 
 def show_image(display, image):
-    display.ShowImage(image)
+    shadow.show(image)
 
 # Initialize display and backlight
 disp = init_display()
 clear_display(disp)
 set_backlight(disp, 100)
 
+# Copy of what is on the panel, so frames only push the pixels that changed
+shadow = ShadowFramebuffer(disp)
+
+# Decoder state (last keyframe) that delta frames are composited onto.
+# Images come out at the panel size: JPEGs are decoded at reduced scale when
+# oversized, and frames of any other size are scaled and letterboxed.
+decoder = codec.FrameDecoder((disp.width, disp.height))
+
 # === NETWORK CONFIGURATION ===
 HOST = "0.0.0.0"
 PORT = 5000
+# Room for several raw RGB565 frames, so the sender never waits on the Pi's reads
+RECV_BUFFER = 1 << 20
 
 # Get the Pi's hostname
 hostname = os.uname()[1]
@@ -42,7 +66,7 @@ def get_wifi_ssid():
         ssid = subprocess.check_output(["iwgetid", "-r"], stderr=subprocess.DEVNULL)
         ssid = ssid.decode("utf-8").strip()
         return f"WiFi: {ssid}" if ssid else "WiFi: Not connected"
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         return "WiFi: Not connected"
 
 
@@ -73,48 +97,56 @@ def display_waiting_message():
     show_image(disp, image)
 
 
-def receive_image(conn):
-    """
-    Receive and decompress an image over the socket connection.
-    Returns:
-      - True if a valid image was received and displayed.
-      - None, False if the client disconnected or an error occurred.
-    """
-    try:
-        # Read 8 bytes for the size
-        size_data = conn.recv(8)
-        if not size_data or len(size_data) < 8:
-            print("No data received. Client may have disconnected.")
-            return None, False
-
-        image_size = int.from_bytes(size_data, byteorder="big")
-        print(f"Receiving compressed image of size: {image_size} bytes.")
-
-        # Read the full compressed image
-        received_data = b""
-        while len(received_data) < image_size:
-            chunk = conn.recv(min(4096, image_size - len(received_data)))
-            if not chunk:
-                print("Connection lost during image reception.")
-                return None, False
-            received_data += chunk
+def print_spi_stats():
+    """Print how many SPI bytes the shadow framebuffer saved per frame."""
+    stats = shadow.stats()
+    if not stats["frames"]:
+        return
+    sent = stats["bytes_sent"] / stats["frames"]
+    saved = stats["bytes_saved"] / stats["frames"]
+    print(f"SPI: {stats['frames']} frames, {sent:.0f} bytes/frame sent, {saved:.0f} bytes/frame saved")
+    if VIRTUAL_DISPLAY:
+        bus = disp.panel.stats()
+        print(f"Virtual panel: {bus['transfers']} transfers, {bus['bytes']} bytes, "
+              f"{bus['seconds'] * 1000 / stats['frames']:.2f} ms/frame on a {disp.panel.max_speed_hz / 1e6:.0f} MHz bus")
 
-        if len(received_data) != image_size:
-            print(f"Expected {image_size} bytes, got {len(received_data)} bytes.")
-            return None, True  # Keep connection alive but skip
 
-        # Decompress the image
-        decompressed_data = zlib.decompress(received_data)
-
-        # Display the image
-        image = Image.open(BytesIO(decompressed_data))
-        show_image(disp, image)
-
-        return True, True
-
-    except Exception as e:
-        print(f"Error receiving image: {e}")
-        return None, False
+def display_frame(kind, frame):
+    """
+    Show one decoded frame; called from the pipeline's display thread.
+    Raw RGB565 frames go straight to the SPI writer, everything else is an
+    image (already fitted to the panel by the decoder) that the shadow
+    framebuffer packs and diffs first.
+    """
+    if kind == "rgb565":
+        height, width = frame.shape[:2]
+        # Landscape frames on a portrait panel (or the reverse) turn it, as ShowImage does
+        if disp.match_orientation(width, height):
+            shadow.invalidate()
+        if (width, height) != disp.panel_size():
+            print(f"Frame is {width}x{height}, panel is {disp.panel_size()}; skipping.")
+            return
+        shadow.show_packed(frame)
+    else:
+        show_image(disp, frame)
+
+
+def apply_control(payload):
+    """
+    Handle a control frame from the sender; called from the display thread.
+    SET_ROTATION has the panel controller turn the picture (MADCTL), so the
+    sender can skip rotating every frame.
+    """
+    if payload[0] == protocol.CONTROL_SET_ROTATION:
+        rotation = protocol.parse_rotation(payload)
+        try:
+            disp.set_rotation(rotation)
+        except ValueError as e:
+            print(f"Ignoring rotation: {e}")
+            return
+        shadow.invalidate()
+        width, height = disp.panel_size()
+        print(f"Panel rotated {rotation} degrees, frames are {width}x{height}")
 
 
 # === MAIN LOOP ===
@@ -123,6 +155,8 @@ while True:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
             # Allow re-binding the port after a disconnect
             server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Set before listen() so accepted connections inherit it
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
             server.bind((HOST, PORT))
             server.listen(1)
 
@@ -144,16 +178,23 @@ while True:
 
                 print(f"Connection from {addr}")
 
+                decoder.reset()
                 with conn:
-                    # Inner loop: receive frames until client disconnects
-                    while True:
-                        frame_result, keep_alive = receive_image(conn)
-                        if not keep_alive:
-                            print("Client disconnected. Returning to waiting screen...")
-                            break
-                        if frame_result is None:
-                            # Something went wrong with that frame, but keep listening
-                            continue
+                    # Reader, decoder and display threads run until the client disconnects
+                    conn.settimeout(None)
+                    pipeline = ReceivePipeline(conn, decoder, display_frame, on_control=apply_control)
+                    counters = pipeline.run()
+                    if pipeline.error is not None:
+                        print(f"Error receiving image: {pipeline.error}")
+                    print("Client disconnected. Returning to waiting screen...")
+
+                print(f"Frames: {format_counters(counters)}")
+                print_spi_stats()
+
+                # The next sender may not want the panel turned
+                if disp.rotation:
+                    disp.set_rotation(0)
+                    shadow.invalidate()
 
                 # After the connection is closed, we return to the waiting loop
                 print("Waiting for next connection...")